@@ -1,19 +1,93 @@
 #######################################################################################################################
 #
 #   Main entry into the program.  Should use a task scheduler such as Windows Task Scheduler or
-#   cron to run this every hour.
+#   cron to run this every hour, or be started once with --daemon to collect on its own schedule
+#   (see scheduler.py, tuned with the optional "schedule" section of the config file).
+#
+#   Maintenance commands:
+#       --migrate       copy weekly_listings_<week> tables from older databases into the long-format
+#                       listings table (add --drop-legacy to remove them afterwards)
+#       --replay        re-aggregate archived snapshots into the database, optionally limited with
+#                       --start/--end (ISO dates or datetimes, local time) and --realm-id
+#       --rebuild-anomalies
+#                       recompute the price anomaly state and flags from stored listings, optionally for one
+#                       --realm-id
+#       --compact       move hourly listings older than the hot window into monthly shard files and archive
+#                       cold shards (see shards.py, tuned with the "retention" section of the config file)
+#       --export        write snapshots not exported yet to Parquet files in data/export (needs pyarrow), or
+#                       everything again with --full-export
 #
 #######################################################################################################################
 
+import argparse
+import datetime
 import os
+import generic_util as gu
+from archive import SnapshotArchive
 from controller import Controller
+from database_gateway import DatabaseGateway
+from scheduler import Scheduler
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Collects World of Warcraft auction house data")
+    parser.add_argument("--config", default=None, help="config file (default: data/config/my_config.json)")
+    parser.add_argument("--daemon", action="store_true", help="keep running and collect on an internal schedule")
+    parser.add_argument("--migrate", action="store_true", help="migrate legacy weekly tables and exit")
+    parser.add_argument("--drop-legacy", action="store_true", help="drop legacy tables after migrating")
+    parser.add_argument("--replay", action="store_true", help="load archived snapshots into the database and exit")
+    parser.add_argument("--rebuild-anomalies", action="store_true",
+                        help="rebuild price anomaly state and flags from stored listings and exit")
+    parser.add_argument("--compact", action="store_true", help="move old listings into monthly shards and exit")
+    parser.add_argument("--export", action="store_true", help="export new snapshots to Parquet and exit")
+    parser.add_argument("--full-export", action="store_true", help="export the whole history again")
+    parser.add_argument("--start", default=None, help="first snapshot time to replay (ISO format)")
+    parser.add_argument("--end", default=None, help="replay snapshots before this time (ISO format)")
+    parser.add_argument("--realm-id", type=int, default=None,
+                        help="realm id to record migrated rows under, or to replay or rebuild (default: 0 / all)")
+    args = parser.parse_args()
     config_filepath = os.path.join(os.path.dirname(__file__), "data", "config")
-    config_file = os.path.join(config_filepath, "my_config.json")
-    controller = Controller(config_file)
-    controller.main()
+    config_file = args.config if args.config is not None else os.path.join(config_filepath, "my_config.json")
+    config = gu.load_json_file(config_file, default={})
+    if args.migrate:
+        dg = DatabaseGateway(retention_config=config.get("retention"))
+        dg.start_connection()
+        dg.migrate_legacy_tables(realm_id=args.realm_id if args.realm_id is not None else 0,
+                                 drop_legacy=args.drop_legacy)
+        dg.close_connection()
+    elif args.replay:
+        dg = DatabaseGateway(anomaly_config=config.get("anomalies"), retention_config=config.get("retention"))
+        dg.start_connection()
+        SnapshotArchive(dg.log).replay(dg, start_ts=parse_time(args.start, 0), end_ts=parse_time(args.end, None),
+                                       realm_ids=[args.realm_id] if args.realm_id is not None else None)
+        dg.close_connection()
+    elif args.rebuild_anomalies:
+        dg = DatabaseGateway(anomaly_config=config.get("anomalies"), retention_config=config.get("retention"))
+        dg.start_connection()
+        dg.rebuild_price_state(realm_id=args.realm_id)
+        dg.close_connection()
+    elif args.compact:
+        dg = DatabaseGateway(retention_config=config.get("retention"))
+        dg.start_connection()
+        dg.shards.compact()
+        dg.close_connection()
+    elif args.export or args.full_export:
+        dg = DatabaseGateway(read_only=True)
+        dg.start_connection()
+        dg.export_parquet(full=args.full_export)
+        dg.close_connection()
+    elif args.daemon:
+        controller = Controller(config_file)
+        Scheduler(controller, controller.log, controller.ag.config.get("schedule")).run()
+    else:
+        controller = Controller(config_file)
+        controller.main()
+
+
+def parse_time(value, default):
+    if value is None:
+        return default
+    return int(datetime.datetime.fromisoformat(value).timestamp())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,147 @@
+#######################################################################################################################
+#
+#   Online price-anomaly detection.  For every item and realm, a running mean and variance of the log of the
+#   snapshot's minimum price are kept as exponentially weighted moving averages.  Log prices make the score
+#   scale-free: dropping to half price is the same deviation for a 10 silver herb as for a 10,000 gold mount.
+#
+#   Each new snapshot is scored against the state built from the snapshots before it:
+#       z = (log(min_price) - mean) / max(std, min_deviation)
+#   and the state is then updated with the new price.  Items with at least "warmup" earlier snapshots and
+#   |z| >= "threshold" are flagged; a negative z is an underpriced listing (a deal), a positive one a spike.
+#
+#   State per realm is held as parallel NumPy arrays sorted by item id, so scoring and updating a snapshot is
+#   one vectorized pass over its items (searchsorted into the state), with no reads of stored history.
+#   DatabaseGateway persists the state in price_state and the flags in price_alerts, in the same transaction
+#   as the snapshot, and can rebuild both from listings (rebuild_price_state, "python . --rebuild-anomalies").
+#
+#   A snapshot is only applied to items whose state is older than it, so ingesting a snapshot twice, or an
+#   older one late, leaves the state unchanged.
+#
+#######################################################################################################################
+
+import numpy as np
+
+# global variables:
+_default_anomaly_config: dict = \
+    {
+        "enabled": True,
+        "alpha": 0.1,  # weight of the newest snapshot, roughly a 10 snapshot memory
+        "threshold": 3.0,  # |z| at which an item is flagged
+        "warmup": 24,  # snapshots an item needs before it can be flagged
+        "min_deviation": 0.05  # floor on the log-price standard deviation, about 5%
+    }
+_state_columns: [str] = ["item_id", "mean", "var", "samples", "last_ts"]
+
+
+class AnomalyDetector(object):
+
+    def __init__(self, anomaly_config: dict = None):
+        self.config = dict(_default_anomaly_config)
+        self.config.update(anomaly_config or {})
+        self.enabled = self.config["enabled"]
+        self.states = {}  # realm_id -> dict of state columns, sorted by item_id
+
+    def has_state(self, realm_id: int) -> bool:
+        return realm_id in self.states
+
+    def load_state(self, realm_id: int, rows: list):
+        # rows of (item_id, mean, var, samples, last_ts), as stored in price_state
+        table = np.array(rows, dtype=np.float64).reshape(-1, len(_state_columns))
+        order = np.argsort(table[:, 0], kind="stable")
+        self.states[realm_id] = state_from_columns(table[order, 0], table[order, 1], table[order, 2],
+                                                   table[order, 3], table[order, 4])
+
+    def clear(self):
+        self.states = {}
+
+    def observe(self, realm_id: int, snapshot_ts: int, item_ids, prices) -> (dict, list, list):
+        # scores one snapshot and returns (new state, changed state rows, alert rows) without applying it,
+        # commit(realm_id, state) applies it once the rows are stored
+        state = self.states.get(realm_id, empty_state())
+        ids = np.asarray(item_ids, dtype=np.int64)
+        prices = np.asarray(prices, dtype=np.float64)
+        valid = np.isfinite(prices) & (prices > 0)
+        ids = ids[valid]
+        prices = prices[valid]
+        order = np.argsort(ids, kind="stable")
+        ids = ids[order]
+        prices = prices[order]
+        values = np.log(prices)
+        pos = np.searchsorted(state["item_id"], ids)
+        found = pos < len(state["item_id"])
+        found[found] = state["item_id"][pos[found]] == ids[found]
+        known_pos = pos[found]
+        fresh = state["last_ts"][known_pos] < snapshot_ts  # skips snapshots already applied
+        update_pos = known_pos[fresh]
+        x = values[found][fresh]
+        mean = state["mean"][update_pos]
+        var = state["var"][update_pos]
+        samples = state["samples"][update_pos]
+        z = (x - mean) / np.maximum(np.sqrt(var), self.config["min_deviation"])
+        flagged = (samples >= self.config["warmup"]) & (np.abs(z) >= self.config["threshold"])
+        # EWMA mean and variance update
+        alpha = self.config["alpha"]
+        diff = x - mean
+        new_mean = mean + alpha * diff
+        new_var = (1 - alpha) * (var + alpha * diff * diff)
+        updated = {
+            "item_id": state["item_id"].copy(),
+            "mean": state["mean"].copy(),
+            "var": state["var"].copy(),
+            "samples": state["samples"].copy(),
+            "last_ts": state["last_ts"].copy()
+        }
+        updated["mean"][update_pos] = new_mean
+        updated["var"][update_pos] = new_var
+        updated["samples"][update_pos] = samples + 1
+        updated["last_ts"][update_pos] = snapshot_ts
+        # items seen for the first time start from their current price
+        new_ids = ids[~found]
+        new_values = values[~found]
+        merged = merge_state(updated, state_from_columns(
+            new_ids, new_values, np.zeros(len(new_ids)), np.ones(len(new_ids)), np.full(len(new_ids), snapshot_ts)))
+        changed = np.concatenate((state["item_id"][update_pos], new_ids))
+        changed_pos = np.searchsorted(merged["item_id"], np.sort(changed))
+        state_rows = state_rows_at(realm_id, merged, changed_pos)
+        flagged_ids = ids[found][fresh][flagged]
+        alert_rows = list(zip(flagged_ids.tolist(), [realm_id] * len(flagged_ids), [snapshot_ts] * len(flagged_ids),
+                              prices[found][fresh][flagged].astype(np.int64).tolist(),
+                              np.rint(np.exp(mean[flagged])).astype(np.int64).tolist(),
+                              np.round(z[flagged], 3).tolist()))
+        return merged, state_rows, alert_rows
+
+    def commit(self, realm_id: int, state: dict):
+        self.states[realm_id] = state
+
+    def state_rows(self, realm_id: int) -> list:
+        state = self.states.get(realm_id, empty_state())
+        return state_rows_at(realm_id, state, np.arange(len(state["item_id"])))
+
+
+def empty_state() -> dict:
+    return state_from_columns([], [], [], [], [])
+
+
+def state_from_columns(item_ids, mean, var, samples, last_ts) -> dict:
+    return {
+        "item_id": np.asarray(item_ids, dtype=np.int64),
+        "mean": np.asarray(mean, dtype=np.float64),
+        "var": np.asarray(var, dtype=np.float64),
+        "samples": np.asarray(samples, dtype=np.int64),
+        "last_ts": np.asarray(last_ts, dtype=np.int64)
+    }
+
+
+def merge_state(state: dict, additions: dict) -> dict:
+    if len(additions["item_id"]) == 0:
+        return state
+    item_ids = np.concatenate((state["item_id"], additions["item_id"]))
+    order = np.argsort(item_ids, kind="stable")
+    return {column: np.concatenate((state[column], additions[column]))[order] for column in _state_columns}
+
+
+def state_rows_at(realm_id: int, state: dict, positions) -> list:
+    # (item_id, realm_id, mean, var, samples, last_ts) rows for price_state
+    return list(zip(state["item_id"][positions].tolist(), [realm_id] * len(positions),
+                    state["mean"][positions].tolist(), state["var"][positions].tolist(),
+                    state["samples"][positions].tolist(), state["last_ts"][positions].tolist()))
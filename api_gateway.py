@@ -6,13 +6,18 @@
 #       Retrieves every auction for the server whose data
 #       is listed in the config file, then cleans and returns pertinent data.
 #
-#   Auction data is returned in dict format, staying true to JSON standard used in API:
+#   Every auction for an item is kept: clean_auction_data groups the whole snapshot per item and returns
+#   the price distribution in dict format (see auction_stats.py for details):
 #   {
 #       <item_id>:
 #           {
-#               "buyout" : <buyout_price>
-#               "quantity" : <quantity>
-#               "unit_price" : <unit_price>
+#               "min_price" : <lowest unit price>
+#               "median_price" : <median unit price>
+#               "mean_price" : <mean unit price>
+#               "p10_price" : <10th percentile unit price>
+#               "p90_price" : <90th percentile unit price>
+#               "quantity" : <total quantity listed>
+#               "listings" : <number of auctions>
 #           },
 #       <item_id>:
 #           {
@@ -21,6 +26,44 @@
 #       ...
 #   }
 #
+#   By default the auction payload is streamed: the response body is read in chunks and each auction is fed to
+#   the aggregation step as soon as it is parsed, so memory use does not grow with the size of the snapshot.
+#   Set "stream_auctions" to false in the config to download and parse the full payload in one go.
+#
+#   All requests go through one pooled requests.Session, so connections are kept alive between item lookups
+#   and realm probes.  Responses with 429 or 5xx codes are retried with exponential backoff, and the latency
+#   of every request is logged.  Pool size, retries, backoff and timeout are set in the "http" section of
+#   the config file.
+#
+#   Access tokens are cached in data/cache/token_cache.json (readable by the owner only) together with their
+#   expiry time, so they are reused across runs until they are close to expiring.  A 401 response refreshes the
+#   token once and retries.
+#
+#   Auction requests are conditional: the Last-Modified and ETag headers of the last ingested snapshot are kept
+#   per realm in data/cache/snapshot_validators.json.  When Blizzard has not published a new snapshot it answers
+#   304, gather_clean_data returns None and the caller can skip the ingest entirely.  The validators of a new
+#   snapshot are only saved (save_snapshot_validators) once the caller has stored it.
+#
+#   The connected realm id that last returned auction data is kept in data/cache/realm_cache.json and tried
+#   first.  Only when it fails are the other ids in the config probed, all at once, taking the first success.
+#
+#   A gateway can be pointed at one collection target (a region and its list of connected realm ids) that
+#   overrides the region and realm_id of the config file.  Gateways for the same region can share one
+#   TokenState, so several targets collected in parallel use a single token.
+#
+#   gather_commodity_data collects the region-wide commodities auction house.  Its payload is streamed into an
+#   AuctionAccumulator, whose item_id / unit_price / quantity arrays are stored as one columnar batch by
+#   DatabaseGateway.add_commodity_snapshot.  Commodity aggregates are stored in listings under a negative
+#   per-region market id (commodity_market_id), next to the connected realm ids.
+#
+#   Every gateway reports request, download and parse timings and request, byte and auction counts to its
+#   metrics object (see metrics.py), which the controller swaps for a fresh one on every run.
+#
+#   The token and API hosts default to Blizzard's, per region.  An optional "base_urls" section in the config
+#   points them elsewhere, e.g. at the local mock server (see mock_server.py); "{region}" is filled in:
+#       "base_urls": {"token": "http://127.0.0.1:8765/{region}/oauth/token",
+#                     "api": "http://127.0.0.1:8765/{region}/data/wow/"}
+#
 #   Requires a config file.  An example config file can be found in the sample_data folder, and more information
 #   is available in the README.
 #
@@ -30,17 +73,29 @@ import json
 import requests
 import generic_util as gu
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from auction_stats import AuctionAccumulator
+from json_stream import iter_array_items
+from metrics import RunMetrics
 
 # global variables:
 _token_url_by_region: dict = \
     {
         "us": "https://us.battle.net/oauth/token",
         "eu": "https://eu.battle.net/oauth/token",
+        "kr": "https://kr.battle.net/oauth/token",
+        "tw": "https://tw.battle.net/oauth/token",
     }
 _api_url_by_region: dict = \
     {
         "us": "https://us.api.blizzard.com/data/wow/",
         "eu": "https://eu.api.blizzard.com/data/wow/",
+        "kr": "https://kr.api.blizzard.com/data/wow/",
+        "tw": "https://tw.api.blizzard.com/data/wow/",
     }
 _url_pieces: dict = \
     {
@@ -48,129 +103,403 @@ _url_pieces: dict = \
             {
                 "before_id": "connected-realm/",
                 "before_region": "/auctions?namespace=dynamic-",
-                "before_locale": "&locale=",
-                "before_token": "&access_token="
+                "before_locale": "&locale="
+            },
+        "commodities":
+            {
+                "before_id": "auctions/commodities",
+                "before_region": "?namespace=dynamic-",
+                "before_locale": "&locale="
             },
         "item":
             {
                 "before_id": "item/",
                 "before_region": "?namespace=static-",
-                "before_locale": "&locale=",
-                "before_token": "&access_token="
+                "before_locale": "&locale="
             }
     }
 _error_codes: [str] = [404]  # expand this list
+_stream_chunk_size: int = 64 * 1024
+_default_http_config: dict = \
+    {
+        "pool_size": 10,
+        "retries": 3,
+        "backoff_factor": 0.5,
+        "timeout": 30
+    }
+_retry_codes: [int] = [429, 500, 502, 503, 504]
+_token_cache_file: str = "token_cache.json"
+_token_expiry_margin: int = 300  # seconds before expiry at which a cached token is no longer used
+_validators_cache_file: str = "snapshot_validators.json"
+_realm_cache_file: str = "realm_cache.json"
+_not_modified: int = 304
+_commodity_market_ids: dict = \
+    {
+        "us": -1,
+        "eu": -2,
+        "kr": -3,
+        "tw": -4
+    }
 _log_filename: str = "api_gateway"
 
 
+class TokenState(object):
+
+    def __init__(self):
+        self.token = None
+        self.expires_at = 0
+        self.lock = threading.Lock()
+
+
 class APIGateway(object):
 
-    def __init__(self, config_file="config.json", logger=None):
+    def __init__(self, config_file="config.json", logger=None, target: dict = None, token_state: TokenState = None):
         if logger is not None:
             self.log = logger
         else:
             self.log = gu.initialize_logger("api_gateway.py")
         # the following block is handled with load_config:
+        self.config = {}
         self.region = None
         self.token_data = None
         self.realm_id_list = None
         self.locale = None
+        self.stream_auctions = True
         self.load_config(config_file)
         # end load_config block
-        self.token = None
+        if target is not None:
+            self.load_target(target)
+        self.token_state = token_state if token_state is not None else TokenState()
+        self.realm_id = None  # the connected realm id that answered the last auction request
+        self.last_modified = None  # Last-Modified header of the last auction snapshot, if any
+        self.pending_validators = {}  # validator key -> headers of a snapshot that has not been stored yet
+        self.http_config = dict(_default_http_config)
+        self.http_config.update(self.config.get("http", {}))
+        self.session = build_session(self.http_config)
+        self.metrics = RunMetrics()  # replaced by the controller's metrics for each run
 
     def load_config(self, config):
         if os.path.isfile(config):
             with open(config, 'r') as openfile:
                 config_json = json.load(openfile)
+            self.config = config_json
             self.token_data = config_json["token_data"]
             self.realm_id_list = config_json["realm_id"]
             if type(self.realm_id_list) is not list:
                 self.realm_id_list = [self.realm_id_list]  # big brain
             self.region = config_json["region"]
             self.locale = config_json["locale"]
+            self.stream_auctions = config_json.get("stream_auctions", True)
         else:
             self.log.error("Config file not found: " + config)
 
+    def load_target(self, target: dict):
+        self.region = target.get("region", self.region)
+        self.locale = target.get("locale", self.locale)
+        self.realm_id_list = target.get("realm_id", self.realm_id_list)
+        if type(self.realm_id_list) is not list:
+            self.realm_id_list = [self.realm_id_list]
+        self.token_data = target.get("token_data", self.token_data)
+
+    @property
+    def token(self):
+        return self.token_state.token
+
+    @token.setter
+    def token(self, value):
+        self.token_state.token = value
+
+    @property
+    def token_expires_at(self):
+        return self.token_state.expires_at
+
+    @token_expires_at.setter
+    def token_expires_at(self, value):
+        self.token_state.expires_at = value
+
+    @property
+    def token_lock(self):
+        return self.token_state.lock
+
+    def target_name(self) -> str:
+        return "{}:{}".format(self.region, ",".join(str(realm_id) for realm_id in self.realm_id_list))
+
     def fetch_token(self):
-        url = _token_url_by_region[self.region]
-        token_post = requests.post(url, self.token_data)
+        url = self.base_url("token")
+        token_post = self.request("POST", url, authorize=False, stage="token", data=self.token_data)
         token_post.close()
         token_json = json.loads(token_post.text)
         self.token = token_json["access_token"]
+        self.token_expires_at = time.time() + token_json.get("expires_in", 0)
         self.log.info("Token received!")
+        gu.update_json_file(gu.get_cache_file(_token_cache_file), self.token_cache_key(),
+                            {"access_token": self.token, "expires_at": self.token_expires_at}, private=True)
+
+    def ensure_token(self):
+        # reuse the token held in memory or on disk, only asking for a new one when it is about to expire
+        with self.token_lock:
+            if self.token is not None and self.token_expires_at - _token_expiry_margin > time.time():
+                return
+            cached = gu.load_json_file(gu.get_cache_file(_token_cache_file), default={}).get(self.token_cache_key())
+            if cached is not None and cached["expires_at"] - _token_expiry_margin > time.time():
+                self.token = cached["access_token"]
+                self.token_expires_at = cached["expires_at"]
+                self.log.info("Using cached token")
+                return
+            self.fetch_token()
+
+    def refresh_token(self, rejected_token):
+        # several threads can see the same 401, only the first one fetches a new token
+        with self.token_lock:
+            if self.token == rejected_token:
+                self.fetch_token()
 
-    def fetch_ah_data(self) -> dict:
-        # try each realm id in list of connected realms until we get one that doesn't error
+    def token_cache_key(self) -> str:
+        return "{}:{}".format(self.region, self.token_data.get("client_id", ""))
+
+    def open_ah_response(self):
+        # the realm id that answered last time is tried first; if it fails, every other id in the list
+        # of connected realms is probed at once and the first one that doesn't error wins
+        # the body is not downloaded until the caller reads it
+        validators = gu.load_json_file(gu.get_cache_file(_validators_cache_file), default={})
+        realm_cache_file = gu.get_cache_file(_realm_cache_file)
+        cached_realm_id = gu.load_json_file(realm_cache_file, default={}).get(self.target_name())
+        candidates = list(self.realm_id_list)
         this_attempt = None
-        self.log.info('###################### AUCTION ACCESS START ######################')
-        self.log.info("TIME: " + gu.get_timestamp(human_readable=True))
-        for realm_id in self.realm_id_list:
-            ah_url = self.build_url(url_type="auction", data=realm_id)
-            this_attempt = requests.get(ah_url)
-            this_attempt.close()
-            self.log.info("Attempted call to: " + ah_url)
-            if this_attempt.status_code not in _error_codes:
-                # We hit a good one
-                self.log.info("Realm ID " + str(realm_id) + " returned a valid code: " + str(this_attempt.status_code))
-                break
+        if cached_realm_id in candidates:
+            candidates.remove(cached_realm_id)
+            this_attempt = self.try_realm(cached_realm_id, validators)
+            if this_attempt is not None:
+                self.realm_id = cached_realm_id
             else:
-                self.log.info("Error code received: " + str(this_attempt.status_code))
+                self.log.info("Cached realm ID {} failed, probing the remaining realm ids".format(cached_realm_id))
+        if this_attempt is None and len(candidates) > 0:
+            this_attempt = self.probe_realms(candidates, validators)
+        if this_attempt is None:
+            self.log.warning("While retrieving auction data, no realm id returned a valid code")
+            return None
+        if self.realm_id != cached_realm_id:
+            gu.update_json_file(realm_cache_file, self.target_name(), self.realm_id)
+        if this_attempt.status_code != _not_modified:
+            self.last_modified = this_attempt.headers.get("Last-Modified")
+            self.pending_validators[self.validator_key(self.realm_id)] = response_validators(this_attempt)
+        return this_attempt
+
+    def try_realm(self, realm_id, validators: dict):
+        ah_url = self.build_url(url_type="auction", data=realm_id)
+        try:
+            this_attempt = self.request("GET", ah_url, stream=True,
+                                        headers=conditional_headers(validators.get(self.validator_key(realm_id))))
+        except requests.RequestException as e:
+            self.log.info("Call to {} failed: {}".format(ah_url, e))
+            return None
+        self.log.info("Attempted call to: " + ah_url)
         if this_attempt.status_code in _error_codes:
-            self.log.warning("While retrieving auction data, the following code was received:")
-            self.log.warning(str(this_attempt.status_code))
+            self.log.info("Error code received: " + str(this_attempt.status_code))
+            this_attempt.close()
+            return None
+        # We hit a good one
+        self.log.info("Realm ID " + str(realm_id) + " returned a valid code: " + str(this_attempt.status_code))
+        return this_attempt
+
+    def probe_realms(self, realm_ids: list, validators: dict):
+        winner = None
+        pool = ThreadPoolExecutor(max_workers=len(realm_ids))
+        futures = {pool.submit(self.try_realm, realm_id, validators): realm_id for realm_id in realm_ids}
+        for future in as_completed(futures):
+            if future.result() is not None:
+                winner = future.result()
+                self.realm_id = futures[future]
+                break
+        for future in futures:
+            # late successes are closed without reading their body
+            future.add_done_callback(lambda done: close_unless(done.result(), winner))
+        pool.shutdown(wait=False)
+        return winner
+
+    def fetch_ah_data(self):
+        # returns None when the snapshot has not changed since the last one we stored
+        self.log.info('###################### AUCTION ACCESS START ######################')
+        self.log.info("TIME: " + gu.get_timestamp(human_readable=True))
+        this_attempt = self.open_ah_response()
+        if this_attempt is None:
             data = {}  # return an empty dict if we never accepted data other than error codes
+        elif this_attempt.status_code == _not_modified:
+            this_attempt.close()
+            self.log.info("Auction data not modified since the last snapshot")
+            data = None
         else:
-            data = json.loads(this_attempt.text)
+            with self.metrics.stage("download"):
+                body = this_attempt.content
+            this_attempt.close()
+            self.metrics.count("bytes", len(body))
+            with self.metrics.stage("parse"):
+                data = json.loads(body)
         self.log.info("TIME: " + gu.get_timestamp(human_readable=True))
         self.log.info('####################### AUCTION ACCESS END #######################')
         return data
 
+    def stream_ah_data(self):
+        # same as auction_accumulator(self.fetch_ah_data()), without holding the raw payload in memory
+        self.log.info('###################### AUCTION ACCESS START ######################')
+        self.log.info("TIME: " + gu.get_timestamp(human_readable=True))
+        accumulator = AuctionAccumulator()
+        this_attempt = self.open_ah_response()
+        if this_attempt is not None and this_attempt.status_code == _not_modified:
+            this_attempt.close()
+            self.log.info("Auction data not modified since the last snapshot")
+            self.log.info('####################### AUCTION ACCESS END #######################')
+            return None
+        if this_attempt is not None:
+            try:
+                with self.metrics.stage("parse"):
+                    stream_auctions(self.metrics.timed_chunks(this_attempt.iter_content(chunk_size=_stream_chunk_size)),
+                                    accumulator)
+            finally:
+                this_attempt.close()
+            self.metrics.count("auctions", len(accumulator))
+            self.log.info("Streamed {} auctions".format(len(accumulator)))
+        self.log.info("TIME: " + gu.get_timestamp(human_readable=True))
+        self.log.info('####################### AUCTION ACCESS END #######################')
+        return accumulator
+
     def fetch_item_data(self, item_id) -> dict:
         if not self.check_token_status("gather item names"):
             return {}
         else:
+            self.ensure_token()
             item_url = self.build_url(url_type="item", data=item_id)
-            self.log.info('###################### ITEM ACCESS START ######################')
-            self.log.info("Reaching out to item api at: " + gu.get_timestamp(human_readable=True))
-            this_item = requests.get(item_url)
+            self.log.debug('###################### ITEM ACCESS START ######################')
+            self.log.debug("Reaching out to item api at: " + gu.get_timestamp(human_readable=True))
+            this_item = self.request("GET", item_url)
             this_item.close()
-            self.log.info("Attempted call to: " + item_url)
+            self.log.debug("Attempted call to: " + item_url)
             if this_item.status_code not in _error_codes:
                 item_data = json.loads(this_item.text)
                 item_name = item_data["name"]
                 item_quality = item_data["quality"]["type"]
-                self.log.info("Name collected: " + item_name)
+                self.log.debug("Name collected: " + item_name)
             else:
                 self.log.warning("Received error code: " + str(this_item.status_code))
                 item_name = "UNKNOWN"
-            self.log.info('####################### ITEM ACCESS END #######################')
+                item_quality = "UNKNOWN"
+            self.log.debug('####################### ITEM ACCESS END #######################')
             useful_item_data = {
                 "name": item_name,
                 "quality": item_quality
             }
             return useful_item_data
 
+    def request(self, method: str, url: str, authorize: bool = True, stage: str = "request",
+                **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.http_config["timeout"])
+        used_token = self.token
+        headers = dict(kwargs.pop("headers", None) or {})
+        if authorize:
+            headers["Authorization"] = "Bearer " + str(used_token)
+        kwargs["headers"] = headers
+        response = self.send(method, url, stage, **kwargs)
+        if authorize and response.status_code == 401:
+            self.log.warning("Token rejected, refreshing and retrying once")
+            response.close()
+            self.refresh_token(used_token)
+            headers["Authorization"] = "Bearer " + str(self.token)
+            response = self.send(method, url, stage, **kwargs)
+        return response
+
+    def send(self, method: str, url: str, stage: str, **kwargs) -> requests.Response:
+        # one timed and logged round trip, see request()
+        start = time.perf_counter()
+        with self.metrics.stage(stage):
+            response = self.session.request(method, url, **kwargs)
+        elapsed = (time.perf_counter() - start) * 1000
+        self.metrics.count("requests")
+        self.log.debug("{} {} -> {} in {:.0f}ms".format(method, url.split("?")[0], response.status_code, elapsed))
+        return response
+
+    def close(self):
+        self.session.close()
+
+    def base_url(self, kind: str) -> str:
+        # kind is "token" or "api"
+        configured = self.config.get("base_urls", {}).get(kind)
+        if configured is not None:
+            return configured.format(region=self.region)
+        return _token_url_by_region[self.region] if kind == "token" else _api_url_by_region[self.region]
+
     def build_url(self, url_type, data) -> str:
-        url = _api_url_by_region[self.region]
+        url = self.base_url("api")
         url += _url_pieces[url_type]["before_id"]
         url += str(data)
         url += _url_pieces[url_type]["before_region"]
         url += self.region
         url += _url_pieces[url_type]["before_locale"]
         url += self.locale
-        url += _url_pieces[url_type]["before_token"]
-        url += self.token
         return url
 
-    def gather_clean_data(self) -> dict:
+    def gather_clean_data(self):
+        # returns None when Blizzard reports the snapshot as unchanged
+        accumulator = self.gather_auction_data()
+        if accumulator is None:
+            return None
+        return accumulator.summarize()
+
+    def gather_auction_data(self):
+        # returns every auction of the snapshot in an AuctionAccumulator, or None when it is unchanged
         if not self.check_token_status("gather auction data"):
-            return {}
+            return AuctionAccumulator()
         else:
-            self.fetch_token()
+            self.ensure_token()
+            if self.stream_auctions:
+                return self.stream_ah_data()
             auction_data = self.fetch_ah_data()
-            clean_data = clean_auction_data(auction_data)
-            return clean_data
+            if auction_data is None:
+                return None
+            with self.metrics.stage("parse"):
+                accumulator = auction_accumulator(auction_data)
+            self.metrics.count("auctions", len(accumulator))
+            return accumulator
+
+    def gather_commodity_data(self):
+        # returns an AuctionAccumulator with every commodity auction of the region, or None when unchanged
+        accumulator = AuctionAccumulator()
+        if not self.check_token_status("gather commodity data"):
+            return accumulator
+        self.ensure_token()
+        self.log.info('###################### COMMODITY ACCESS START ######################')
+        commodity_url = self.build_url(url_type="commodities", data="")
+        validators = gu.load_json_file(gu.get_cache_file(_validators_cache_file), default={})
+        this_attempt = self.request("GET", commodity_url, stream=True,
+                                    headers=conditional_headers(validators.get(self.validator_key("commodities"))))
+        try:
+            if this_attempt.status_code == _not_modified:
+                self.log.info("Commodity data not modified since the last snapshot")
+                return None
+            if this_attempt.status_code != 200:
+                self.log.warning("While retrieving commodity data, the following code was received: " +
+                                 str(this_attempt.status_code))
+                return accumulator
+            self.pending_validators[self.validator_key("commodities")] = response_validators(this_attempt)
+            with self.metrics.stage("parse"):
+                stream_auctions(self.metrics.timed_chunks(this_attempt.iter_content(chunk_size=_stream_chunk_size)),
+                                accumulator)
+            self.metrics.count("auctions", len(accumulator))
+            self.log.info("Streamed {} commodity auctions".format(len(accumulator)))
+        finally:
+            this_attempt.close()
+            self.log.info('####################### COMMODITY ACCESS END #######################')
+        return accumulator
+
+    def save_snapshot_validators(self, realm_id=None):
+        # call once the snapshot has been stored, so a failed ingest is fetched again on the next run
+        # realm_id is "commodities" for the commodity snapshot, and defaults to the realm that answered last
+        key = self.validator_key(realm_id if realm_id is not None else self.realm_id)
+        if key not in self.pending_validators:
+            return
+        gu.update_json_file(gu.get_cache_file(_validators_cache_file), key, self.pending_validators.pop(key))
+
+    def validator_key(self, realm_id) -> str:
+        return "{}:{}".format(self.region, realm_id)
 
     def check_token_status(self, message) -> bool:
         if self.token_data is None:
@@ -179,20 +508,59 @@ class APIGateway(object):
         return True
 
 
+def build_session(http_config: dict) -> requests.Session:
+    retry = Retry(total=http_config["retries"], backoff_factor=http_config["backoff_factor"],
+                  status_forcelist=_retry_codes, allowed_methods=["GET", "POST"], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=http_config["pool_size"], pool_maxsize=http_config["pool_size"],
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+    return session
+
+
+def commodity_market_id(region: str) -> int:
+    return _commodity_market_ids[region]
+
+
+def response_validators(response) -> dict:
+    return {
+        "last_modified": response.headers.get("Last-Modified"),
+        "etag": response.headers.get("ETag")
+    }
+
+
+def close_unless(response, keep):
+    if response is not None and response is not keep:
+        response.close()
+
+
+def conditional_headers(validators) -> dict:
+    headers = {}
+    if validators is not None:
+        if validators.get("last_modified") is not None:
+            headers["If-Modified-Since"] = validators["last_modified"]
+        if validators.get("etag") is not None:
+            headers["If-None-Match"] = validators["etag"]
+    return headers
+
+
 def clean_auction_data(auction_data) -> dict:
-    auction_list = auction_data["auctions"]
-    clean_data = {}
-    for auction in auction_list:
-        item_id = auction["item"]["id"]
-        possible_keys = ["quantity", "buyout", "unit_price"]
-        temp_dict = {}
-        for key in possible_keys:
-            if key in auction:
-                temp_dict.update({key: auction[key]})
-            else:
-                temp_dict.update({key: "NONE"})
-        clean_data.update({item_id: temp_dict})
-    return clean_data
+    return auction_accumulator(auction_data).summarize()
+
+
+def auction_accumulator(auction_data) -> AuctionAccumulator:
+    accumulator = AuctionAccumulator()
+    for auction in auction_data.get("auctions", []):
+        accumulator.add_auction(auction)
+    return accumulator
+
+
+def stream_auctions(chunks, accumulator: AuctionAccumulator) -> AuctionAccumulator:
+    for auction in iter_array_items(chunks, "auctions"):
+        accumulator.add_auction(auction)
+    return accumulator
 
 
 #######################################################################################################################
@@ -219,6 +587,8 @@ if __name__ == "__main__":
     if os.path.isfile(config_filename):
         ag = APIGateway(config_file=config_filename)
         cleaned_data = ag.gather_clean_data()
+        if cleaned_data is None:
+            cleaned_data = {}
         data_outfile = "sample." + gu.get_timestamp(human_readable=False) + ".json"
         data_filename = os.path.join(sample_data_folder, data_outfile)
         data_filename = os.path.normpath(data_filename)
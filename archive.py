@@ -0,0 +1,78 @@
+#######################################################################################################################
+#
+#   Archive of raw auction snapshots, and replay of archived snapshots into the database.
+#
+#   Every collected snapshot can be written to data/archive/<realm_id>/<snapshot_ts>.npz: the item_id,
+#   unit_price and quantity of every auction as compressed columns (np.savez_compressed, dtypes from
+#   columnar.py).  That is the full input to the aggregation step, so any range of archived hours can be
+#   re-aggregated and bulk-loaded with replay() (python . --replay) to rebuild or re-derive history without
+#   refetching.  Commodity snapshots are archived under their negative market id.
+#
+#######################################################################################################################
+
+import os
+import time
+import numpy as np
+import columnar
+from auction_stats import AuctionAccumulator
+
+# global variables:
+_archive_path: str = os.path.join(os.path.dirname(__file__), "data", "archive")
+_archive_columns: [str] = ["item_id", "unit_price", "quantity"]
+
+
+class SnapshotArchive(object):
+
+    def __init__(self, logger, archive_path: str = _archive_path):
+        self.log = logger
+        self.archive_path = archive_path
+
+    def write(self, realm_id: int, snapshot_ts: int, accumulator: AuctionAccumulator) -> str:
+        folder = os.path.join(self.archive_path, str(realm_id))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        filename = os.path.join(folder, "{}.npz".format(snapshot_ts))
+        columns = columnar.accumulator_columns(accumulator)
+        np.savez_compressed(filename, **{column: columnar.cast_column(column, columns[column])
+                                         for column in _archive_columns})
+        self.log.info("Archived {} auctions to {}".format(len(accumulator), filename))
+        return filename
+
+    def read(self, realm_id: int, snapshot_ts: int) -> AuctionAccumulator:
+        filename = os.path.join(self.archive_path, str(realm_id), "{}.npz".format(snapshot_ts))
+        with np.load(filename) as archived:
+            return columnar.columns_to_accumulator({column: archived[column] for column in _archive_columns})
+
+    def list_snapshots(self, start_ts: int = 0, end_ts: int = None, realm_ids: list = None) -> [(int, int)]:
+        # (realm_id, snapshot_ts) pairs in [start_ts, end_ts), ordered by time
+        snapshots = []
+        if not os.path.exists(self.archive_path):
+            return snapshots
+        for realm_folder in os.listdir(self.archive_path):
+            try:
+                realm_id = int(realm_folder)
+            except ValueError:
+                continue
+            if realm_ids is not None and realm_id not in realm_ids:
+                continue
+            for filename in os.listdir(os.path.join(self.archive_path, realm_folder)):
+                if not filename.endswith(".npz"):
+                    continue
+                snapshot_ts = int(filename[:-len(".npz")])
+                if snapshot_ts >= start_ts and (end_ts is None or snapshot_ts < end_ts):
+                    snapshots.append((realm_id, snapshot_ts))
+        snapshots.sort(key=lambda pair: (pair[1], pair[0]))
+        return snapshots
+
+    def replay(self, db_gateway, start_ts: int = 0, end_ts: int = None, realm_ids: list = None) -> int:
+        # re-aggregates and ingests every archived snapshot in range, returns the number of snapshots loaded
+        start = time.perf_counter()
+        snapshots = self.list_snapshots(start_ts, end_ts, realm_ids)
+        loaded = 0
+        for realm_id, snapshot_ts in snapshots:
+            data = self.read(realm_id, snapshot_ts).summarize()
+            if db_gateway.add_auction_data(data, realm_id=realm_id, snapshot_ts=snapshot_ts):
+                loaded += 1
+        self.log.info("Replayed {} of {} archived snapshots in {:.2f}s".format(
+            loaded, len(snapshots), time.perf_counter() - start))
+        return loaded
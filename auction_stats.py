@@ -0,0 +1,116 @@
+#######################################################################################################################
+#
+#   Aggregates every auction in a snapshot into per-item price statistics.  Auctions are collected into flat
+#   arrays (item id, unit price, quantity) and grouped in a single vectorized pass with NumPy.
+#
+#   Realm auctions carry either a "buyout" for the whole stack or a "unit_price" (commodities).  Both are reduced
+#   to a price per unit and weighted by quantity, so a stack of 200 counts 200 times toward the median while a
+#   single piece of gear counts once.  Bid-only auctions have no price to use and are skipped.
+#
+#   summarize() returns data in dict format, as consumed by DatabaseGateway.add_auction_data:
+#   {
+#       <item_id>:
+#           {
+#               "min_price" : <lowest unit price>
+#               "median_price" : <quantity-weighted median unit price>
+#               "mean_price" : <quantity-weighted mean unit price>
+#               "p10_price" : <quantity-weighted 10th percentile unit price>
+#               "p90_price" : <quantity-weighted 90th percentile unit price>
+#               "quantity" : <total quantity listed>
+#               "listings" : <number of auctions>
+#           },
+#       ...
+#   }
+#
+#######################################################################################################################
+
+import array
+import numpy as np
+
+# global variables:
+_stat_keys: [str] = ["min_price", "median_price", "mean_price", "p10_price", "p90_price", "quantity", "listings"]
+
+
+class AuctionAccumulator(object):
+
+    def __init__(self):
+        # array.array keeps a compact buffer that NumPy can read without copying auction dicts around
+        self.item_ids = array.array('q')
+        self.unit_prices = array.array('d')
+        self.quantities = array.array('q')
+
+    def __len__(self) -> int:
+        return len(self.item_ids)
+
+    def add_auction(self, auction: dict):
+        self.add(item_id=auction["item"]["id"],
+                 buyout=auction.get("buyout"),
+                 unit_price=auction.get("unit_price"),
+                 quantity=auction.get("quantity", 1))
+
+    def add(self, item_id, buyout=None, unit_price=None, quantity=1):
+        if quantity is None or quantity == "NONE" or int(quantity) < 1:
+            quantity = 1
+        quantity = int(quantity)
+        if unit_price is not None and unit_price != "NONE":
+            price = float(unit_price)
+        elif buyout is not None and buyout != "NONE":
+            price = float(buyout) / quantity
+        else:
+            return  # bid-only auction
+        self.item_ids.append(int(item_id))
+        self.unit_prices.append(price)
+        self.quantities.append(quantity)
+
+    def aggregate(self) -> dict:
+        return aggregate_prices(np.frombuffer(self.item_ids, dtype=np.int64),
+                                np.frombuffer(self.unit_prices, dtype=np.float64),
+                                np.frombuffer(self.quantities, dtype=np.int64))
+
+    def summarize(self) -> dict:
+        return columns_to_dict(self.aggregate())
+
+
+def aggregate_prices(item_ids, unit_prices, quantities) -> dict:
+    # returns one array per statistic, aligned with the sorted unique item ids under "item_id"
+    if len(item_ids) == 0:
+        empty = {"item_id": np.zeros(0, dtype=np.int64)}
+        for key in _stat_keys:
+            empty[key] = np.zeros(0, dtype=np.int64)
+        return empty
+    order = np.lexsort((unit_prices, item_ids))
+    ids = item_ids[order]
+    prices = unit_prices[order]
+    weights = quantities[order]
+    starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+    listings = np.diff(np.append(starts, len(ids)))
+    total_quantity = np.add.reduceat(weights, starts)
+    weighted_sum = np.add.reduceat(prices * weights, starts)
+    cumulative = np.cumsum(weights)
+    before_group = cumulative[starts] - weights[starts]
+
+    def weighted_quantile(q: float):
+        # first listing whose cumulative quantity reaches the q-th share of the item's total quantity
+        target = before_group + q * total_quantity
+        positions = np.searchsorted(cumulative, target, side="left")
+        return prices[np.minimum(positions, len(prices) - 1)]
+
+    columns = {
+        "item_id": ids[starts],
+        "min_price": np.rint(prices[starts]).astype(np.int64),
+        "median_price": np.rint(weighted_quantile(0.5)).astype(np.int64),
+        "mean_price": np.rint(weighted_sum / total_quantity).astype(np.int64),
+        "p10_price": np.rint(weighted_quantile(0.1)).astype(np.int64),
+        "p90_price": np.rint(weighted_quantile(0.9)).astype(np.int64),
+        "quantity": total_quantity.astype(np.int64),
+        "listings": listings.astype(np.int64),
+    }
+    return columns
+
+
+def columns_to_dict(columns: dict) -> dict:
+    stat_lists = [columns[key].tolist() for key in _stat_keys]
+    clean_data = {}
+    for row, item_id in enumerate(columns["item_id"].tolist()):
+        clean_data[item_id] = {key: stat_lists[i][row] for i, key in enumerate(_stat_keys)}
+    return clean_data
@@ -0,0 +1,81 @@
+#######################################################################################################################
+#
+#   Fills in names and qualities for items that were collected from the auction house but not yet looked up.
+#   Item lookups run on a bounded thread pool, and every request first takes a token from a shared token
+#   bucket so the combined request rate stays within Blizzard's quota (100 requests per second at the time
+#   of writing).  All results of a run are written back to the database in one batched UPDATE.
+#
+#   Lookups that fail outright (connection errors, timeouts) are left as UNDEFINED and retried on a later run.
+#
+#######################################################################################################################
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# global variables:
+_default_concurrency: int = 8
+_default_requests_per_second: float = 100.0
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate: float, capacity: float = 1, clock=time.monotonic, sleep=time.sleep):
+        # starts empty and holds at most capacity tokens, so no burst ever exceeds the rate: with the default
+        # capacity of 1 any one-second window sees at most rate + 1 requests, even right after a new bucket
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = 0.0
+        self.clock = clock
+        self.sleep = sleep
+        self.last_refill = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+class ItemBackfill(object):
+
+    def __init__(self, api_gateway, db_gateway, logger, concurrency: int = _default_concurrency,
+                 requests_per_second: float = _default_requests_per_second):
+        self.ag = api_gateway
+        self.dg = db_gateway
+        self.log = logger
+        self.concurrency = max(1, int(concurrency))
+        self.bucket = TokenBucket(requests_per_second)
+
+    def fetch(self, item_id: int):
+        self.bucket.acquire()
+        try:
+            return item_id, self.ag.fetch_item_data(item_id)
+        except Exception as e:
+            self.log.warning("Item lookup failed for {}: {}".format(item_id, e))
+            return item_id, {}
+
+    def run(self, limit: int) -> int:
+        # expects an open database connection, returns the number of items written back
+        item_rows = self.dg.find_items_missing_data(limit)
+        items = [item[0] for item in item_rows]
+        if len(items) == 0:
+            return 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            results = list(pool.map(self.fetch, items))
+        updates = [(item_data["name"], item_data["quality"], item_id)
+                   for item_id, item_data in results if "name" in item_data]
+        self.dg.update_items_data(updates)
+        elapsed = time.perf_counter() - start
+        self.log.info("Backfilled {} of {} items in {:.2f}s ({:.0f} items/min)".format(
+            len(updates), len(items), elapsed, len(updates) / elapsed * 60 if elapsed > 0 else 0)
+        )
+        return len(updates)
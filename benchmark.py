@@ -0,0 +1,457 @@
+#######################################################################################################################
+#
+#   Performance benchmarks, run from the command line:
+#       python benchmark.py parse-memory [--scales 1 10]
+#       python benchmark.py concurrent-rw [--snapshots 24] [--readers 4]
+#       python benchmark.py statement-cost [--rows 20000]
+#       python benchmark.py pipeline [--scales 1 10 100] [--runs 5] [--history-days 14] [--save-baseline]
+#       python benchmark.py end-to-end [--runs 5] [--realms 4] [--scale 1] [--latency-ms 20] [--throttle-rate 0.01]
+#
+#   parse-memory:   peak memory of the full-payload parse (read body, json.loads, clean) against the streaming
+#                   parse, on synthetic auction payloads scaled off example_auction_data.json.
+#
+#   concurrent-rw:  one writer ingests hourly snapshots back to back while reader threads keep querying price
+#                   history through read-only connections.  Run once with the legacy rollback-journal settings
+#                   and once with the default WAL profile; reports reader latency percentiles, the longest a
+#                   reader waited, and how many reads failed with "database is locked".
+#
+#   statement-cost: per-row cost of writing item names one statement at a time, with the values formatted into
+#                   the SQL text (a new statement to parse for every row) against bound parameters (one cached
+#                   prepared statement), and against one executemany over all rows.  In-memory database.
+#
+#   pipeline:       the full collection pipeline (parse and clean a snapshot, then add_auction_data) on synthetic
+#                   snapshots at each scale, into a fresh database and into one already holding --history-days
+#                   of hourly snapshots.  The payload file stands in for the Battle.net API, read in the same
+#                   chunks as the HTTP body.  Reports latency percentiles per run, parse and ingest medians,
+#                   auctions and rows per second, and peak memory (tracemalloc, in a separate untimed-for-speed
+#                   run).  Results are compared with the stored baseline (data/benchmark/pipeline_baseline.json,
+#                   written with --save-baseline): a median time or peak memory more than --tolerance above it
+#                   is reported as a regression and the benchmark exits with status 1, as it does when there
+#                   is no baseline to compare with.
+#
+#   end-to-end:     Controller.main, run back to back against the local mock Battle.net API (see mock_server.py)
+#                   with one target per realm plus commodities, through the real HTTP, token, conditional
+#                   request, retry, ingest and backfill paths.  The mock injects latency, 429s and item 404s.
+#                   Reports runs per minute, run time percentiles, the item backfill rate and, per endpoint,
+#                   the request count, status codes and tail latency seen by the server.  The cache files go
+#                   to the temporary directory, so the real token and snapshot validators are left alone.
+#
+#   Payloads and databases are written to a temporary directory, standing in for the HTTP body and data/.
+#
+#######################################################################################################################
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+import api_gateway
+import generic_util as gu
+import synthetic_data
+from auction_stats import AuctionAccumulator
+from controller import Controller
+from database_gateway import DatabaseGateway
+from mock_server import MockBattleNet
+from price_history import PriceHistory
+
+# global variables:
+_chunk_size: int = 64 * 1024
+_rollback_profile: dict = \
+    {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "cache_size": -2000,
+        "mmap_size": 0,
+        "busy_timeout": 100
+    }
+_log = logging.getLogger("benchmark")
+_baseline_file: str = os.path.join(os.path.dirname(__file__), "data", "benchmark", "pipeline_baseline.json")
+_baseline_checks: [str] = ["p50_seconds", "peak_mb"]  # higher is worse for both
+_pipeline_start_ts: int = 1700006400  # fixed hour, so every run writes the same snapshot times
+
+
+def read_chunks(filename: str):
+    with open(filename, 'rb') as rf:
+        while True:
+            chunk = rf.read(_chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def parse_full(filename: str) -> dict:
+    with open(filename, 'rb') as rf:
+        body = rf.read()
+    text = body.decode("utf-8")
+    return api_gateway.clean_auction_data(json.loads(text))
+
+
+def parse_streaming(filename: str) -> dict:
+    accumulator = api_gateway.stream_auctions(read_chunks(filename), AuctionAccumulator())
+    return accumulator.summarize()
+
+
+def measure(function, *args) -> (float, int, object):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def benchmark_parse_memory(scales: [float]) -> [dict]:
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for scale in scales:
+            filename = synthetic_data.write_auction_payload(os.path.join(temp_dir, "auctions_{}x.json".format(scale)),
+                                                            scale=scale)
+            payload_mb = os.path.getsize(filename) / 1e6
+            full_time, full_peak, full_result = measure(parse_full, filename)
+            stream_time, stream_peak, stream_result = measure(parse_streaming, filename)
+            if full_result != stream_result:
+                raise AssertionError("Streaming parse disagrees with full parse at {}x".format(scale))
+            row = {
+                "scale": scale,
+                "payload_mb": round(payload_mb, 1),
+                "full_peak_mb": round(full_peak / 1e6, 1),
+                "full_seconds": round(full_time, 3),
+                "stream_peak_mb": round(stream_peak / 1e6, 1),
+                "stream_seconds": round(stream_time, 3),
+            }
+            print("{scale:>6}x  payload {payload_mb:>7} MB | full: peak {full_peak_mb:>7} MB {full_seconds:>7}s | "
+                  "stream: peak {stream_peak_mb:>7} MB {stream_seconds:>7}s".format(**row))
+            results.append(row)
+    return results
+
+
+def run_concurrent_rw(db_file: str, profile, snapshots: [dict], reader_count: int) -> dict:
+    # profile=None uses DatabaseGateway's default connection profile
+    writer = DatabaseGateway(_log, profile=profile, db_file=db_file)
+    writer.start_connection()
+    writer.add_auction_data(snapshots[0], realm_id=1, snapshot_ts=0)  # readers need tables to exist
+    item_ids = list(snapshots[0].keys())[:200]
+    done = threading.Event()
+    latencies = []
+    errors = []
+
+    def read_loop():
+        reader = DatabaseGateway(_log, profile=profile, read_only=True, db_file=db_file)
+        reader.start_connection()
+        history = PriceHistory(reader)
+        while not done.is_set():
+            start = time.perf_counter()
+            try:
+                history.price_series_many(item_ids, 0, 10 ** 10, realm_id=1, resolution="hourly")
+                latencies.append(time.perf_counter() - start)
+            except sqlite3.OperationalError as e:
+                errors.append(str(e))
+        reader.close_connection()
+
+    readers = [threading.Thread(target=read_loop) for _ in range(reader_count)]
+    for thread in readers:
+        thread.start()
+    write_start = time.perf_counter()
+    for hour, data in enumerate(snapshots[1:], start=1):
+        writer.add_auction_data(data, realm_id=1, snapshot_ts=hour * 3600)
+    write_seconds = time.perf_counter() - write_start
+    done.set()
+    for thread in readers:
+        thread.join()
+    writer.close_connection()
+    latency_ms = np.array(latencies) * 1000 if len(latencies) > 0 else np.zeros(1)
+    return {
+        "journal_mode": writer.profile["journal_mode"],
+        "write_seconds": round(write_seconds, 2),
+        "reads": len(latencies),
+        "read_p50_ms": round(float(np.percentile(latency_ms, 50)), 1),
+        "read_p99_ms": round(float(np.percentile(latency_ms, 99)), 1),
+        "read_max_ms": round(float(latency_ms.max()), 1),
+        "locked_errors": len(errors)
+    }
+
+
+def benchmark_concurrent_rw(snapshot_count: int, reader_count: int) -> [dict]:
+    snapshots = [api_gateway.clean_auction_data(synthetic_data.build_auction_payload(1.5, seed=hour))
+                 for hour in range(snapshot_count + 1)]
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name, profile in [("rollback", _rollback_profile), ("wal", None)]:
+            row = run_concurrent_rw(os.path.join(temp_dir, name + ".db"), profile, snapshots, reader_count)
+            print("{journal_mode:>8} | write {write_seconds:>6}s | {reads:>6} reads | p50 {read_p50_ms:>7} ms "
+                  "p99 {read_p99_ms:>7} ms max {read_max_ms:>7} ms | locked errors {locked_errors}".format(**row))
+            results.append(row)
+    return results
+
+
+def time_statements(rows: [tuple], mode: str) -> float:
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE item_names (item_id INTEGER, item_name TEXT, item_quality TEXT)")
+    conn.execute("CREATE UNIQUE INDEX idx_item_names_item_id ON item_names (item_id)")
+    start = time.perf_counter()
+    with conn:
+        if mode == "formatted":
+            for item_id, item_name, item_quality in rows:
+                conn.execute("INSERT INTO item_names (item_id, item_name, item_quality) VALUES ({}, '{}', '{}')".format(
+                    item_id, item_name.replace("'", "''"), item_quality))
+        elif mode == "bound":
+            for row in rows:
+                conn.execute("INSERT INTO item_names (item_id, item_name, item_quality) VALUES (?, ?, ?)", row)
+        else:
+            conn.executemany("INSERT INTO item_names (item_id, item_name, item_quality) VALUES (?, ?, ?)", rows)
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return elapsed
+
+
+def benchmark_statement_cost(row_count: int) -> [dict]:
+    rows = [(item_id, "Ogre's Cleaver {}".format(item_id), "EPIC") for item_id in range(1, row_count + 1)]
+    results = []
+    for mode in ["formatted", "bound", "executemany"]:
+        elapsed = min(time_statements(rows, mode) for _ in range(3))
+        row = {
+            "mode": mode,
+            "rows": row_count,
+            "seconds": round(elapsed, 3),
+            "us_per_row": round(elapsed / row_count * 1e6, 2)
+        }
+        print("{mode:>11} | {rows:>8} rows | {seconds:>7}s | {us_per_row:>7} us/row".format(**row))
+        results.append(row)
+    return results
+
+
+def run_pipeline(payload_file: str, db_file: str, snapshot_ts: int, parser: str = "stream") -> dict:
+    start = time.perf_counter()
+    if parser == "stream":
+        data = parse_streaming(payload_file)
+    else:
+        data = parse_full(payload_file)
+    parsed = time.perf_counter()
+    dg = DatabaseGateway(_log, db_file=db_file)
+    dg.start_connection()
+    if not dg.add_auction_data(data, realm_id=1, snapshot_ts=snapshot_ts):
+        raise AssertionError("Ingest into {} failed".format(db_file))
+    dg.close_connection()
+    return {
+        "seconds": time.perf_counter() - start,
+        "parse_seconds": parsed - start,
+        "ingest_seconds": time.perf_counter() - parsed,
+        "rows": len(data)
+    }
+
+
+def build_history(db_file: str, days: int):
+    # hourly snapshots of the 1x sample for the days before _pipeline_start_ts, prices drifting by seed
+    daily = [api_gateway.clean_auction_data(synthetic_data.build_auction_payload(1, seed=hour + 2))
+             for hour in range(24)]
+    dg = DatabaseGateway(_log, db_file=db_file)
+    dg.start_connection()
+    for hour in range(days * 24):
+        dg.add_auction_data(daily[hour % 24], realm_id=1, snapshot_ts=_pipeline_start_ts - (days * 24 - hour) * 3600)
+    dg.close_connection()  # checkpoints the WAL, so the file can be copied on its own
+
+
+def benchmark_case(payload_file: str, template_db, temp_dir: str, runs: int, parser: str) -> dict:
+    # template_db=None runs against an empty database, otherwise against a copy of it
+    timings = []
+    peak = 0
+    for run in range(runs + 1):
+        db_file = os.path.join(temp_dir, "pipeline_{}.db".format(run))
+        if template_db is not None:
+            shutil.copyfile(template_db, db_file)
+        if run < runs:
+            timings.append(run_pipeline(payload_file, db_file, _pipeline_start_ts, parser))
+        else:
+            peak = measure(run_pipeline, payload_file, db_file, _pipeline_start_ts, parser)[1]
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(db_file + suffix):
+                os.remove(db_file + suffix)
+    seconds = np.array([timing["seconds"] for timing in timings])
+    return {
+        "runs": runs,
+        "p50_seconds": round(float(np.percentile(seconds, 50)), 3),
+        "p95_seconds": round(float(np.percentile(seconds, 95)), 3),
+        "max_seconds": round(float(seconds.max()), 3),
+        "parse_p50_seconds": round(float(np.median([timing["parse_seconds"] for timing in timings])), 3),
+        "ingest_p50_seconds": round(float(np.median([timing["ingest_seconds"] for timing in timings])), 3),
+        "rows": timings[0]["rows"],
+        "rows_per_second": round(timings[0]["rows"] / float(np.median(seconds))),
+        "peak_mb": round(peak / 1e6, 1)
+    }
+
+
+def benchmark_pipeline(scales: [float], runs: int, history_days: int, parser: str = "stream") -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        history_db = os.path.join(temp_dir, "history.db")
+        start = time.perf_counter()
+        build_history(history_db, history_days)
+        print("Built {} days of history in {:.1f}s".format(history_days, time.perf_counter() - start))
+        for scale in scales:
+            payload_file = synthetic_data.write_auction_payload(
+                os.path.join(temp_dir, "auctions_{}x.json".format(scale)), scale=scale)
+            auctions = int(len(synthetic_data.load_sample_items()) * scale)  # as build_auction_payload counts them
+            for database, template_db in [("fresh", None), ("history", history_db)]:
+                row = benchmark_case(payload_file, template_db, temp_dir, runs, parser)
+                row.update({"scale": scale, "database": database, "auctions": auctions,
+                            "auctions_per_second": round(auctions / row["p50_seconds"])})
+                print("{scale:>6}x {database:>8} | {auctions:>8} auctions | p50 {p50_seconds:>7}s "
+                      "p95 {p95_seconds:>7}s max {max_seconds:>7}s | parse {parse_p50_seconds:>7}s "
+                      "ingest {ingest_p50_seconds:>6}s | {auctions_per_second:>8} auctions/s "
+                      "{rows_per_second:>7} rows/s | peak {peak_mb:>7} MB".format(**row))
+                results["{}x-{}".format(scale, database)] = row
+            os.remove(payload_file)
+    return results
+
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> [str]:
+    regressions = []
+    for case, row in results.items():
+        if case not in baseline:
+            continue
+        for check in _baseline_checks:
+            limit = baseline[case][check] * (1 + tolerance)
+            if row[check] > limit:
+                regressions.append("{} {}: {} against baseline {} (limit {:.3f})".format(
+                    case, check, row[check], baseline[case][check], limit))
+    return regressions
+
+
+def mock_config_file(temp_dir: str, mock: MockBattleNet, realms: [int], items_per_run: int,
+                     backfill_rate: float) -> str:
+    config = {
+        "token_data": {"client_id": "mock", "client_secret": "mock", "grant_type": "client_credentials"},
+        "base_urls": mock.base_urls(),
+        "realm_id": realms,
+        "region": "us",
+        "locale": "en_US",
+        "targets": [{"region": "us", "realm_id": [realm_id]} for realm_id in realms],
+        "commodities": True,
+        "backfill": {"items_per_run": items_per_run, "concurrency": 8, "requests_per_second": backfill_rate},
+        "metrics": {"enabled": False}  # the records are still returned, just not written to data/metrics
+    }
+    filename = os.path.join(temp_dir, "config.json")
+    with open(filename, 'w') as wf:
+        json.dump(config, wf, indent=2)
+    return filename
+
+
+def benchmark_end_to_end(runs: int, realm_count: int, scale: float, latency_ms: float, throttle_rate: float,
+                         item_404_rate: float, items_per_run: int, backfill_rate: float) -> dict:
+    realms = list(range(1, realm_count + 1))
+    mock = MockBattleNet(mock_config={"realms": realms, "scale": scale, "commodity_scale": scale,
+                                      "latency_ms": latency_ms, "throttle_rate": throttle_rate,
+                                      "item_404_rate": item_404_rate}, logger=_log)
+    mock.start()
+    records = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        gu.set_cache_folder(temp_dir)
+        try:
+            config_file = mock_config_file(temp_dir, mock, realms, items_per_run, backfill_rate)
+            controller = Controller(config_file, db_file=os.path.join(temp_dir, "end_to_end.db"))
+            mock.reset_stats()  # the token request of the constructor is not part of a run
+            start = time.perf_counter()
+            for run in range(runs):
+                record = controller.main()
+                print("run {:>3} | {:>7}s | targets ok {:>3} | {:>6} requests {:>8.1f} MB | backfilled {:>5} items "
+                      "in {:>6}s".format(run + 1, record["run_seconds"], record["targets_ok"], record["requests"],
+                                         record["bytes"] / 1e6, record["items_backfilled"],
+                                         record["backfill_seconds"]))
+                records.append(record)
+            elapsed = time.perf_counter() - start
+            for gateway in controller.gateways:
+                gateway.close()
+        finally:
+            mock.stop()
+    run_seconds = np.array([record["run_seconds"] for record in records])
+    backfill_seconds = sum(record["backfill_seconds"] for record in records)
+    backfilled = sum(record["items_backfilled"] for record in records)
+    summary = {
+        "runs": runs,
+        "runs_per_minute": round(runs / elapsed * 60, 2),
+        "run_p50_seconds": round(float(np.percentile(run_seconds, 50)), 3),
+        "run_p95_seconds": round(float(np.percentile(run_seconds, 95)), 3),
+        "run_max_seconds": round(float(run_seconds.max()), 3),
+        "items_backfilled": backfilled,
+        "backfill_items_per_minute": round(backfilled / backfill_seconds * 60) if backfill_seconds > 0 else 0,
+        "endpoints": mock.stats()
+    }
+    print("{runs} runs | {runs_per_minute} runs/min | run p50 {run_p50_seconds}s p95 {run_p95_seconds}s "
+          "max {run_max_seconds}s | backfill {backfill_items_per_minute} items/min".format(**summary))
+    for endpoint, row in summary["endpoints"].items():
+        print("{:>12} | {:>7} requests | p50 {:>8} ms p95 {:>8} ms p99 {:>8} ms max {:>8} ms | {}".format(
+            endpoint, row["requests"], row["p50_ms"], row["p95_ms"], row["p99_ms"], row["max_ms"],
+            ", ".join("{}: {}".format(status, count) for status, count in sorted(row["statuses"].items()))))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AuctionHouseData benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    parse_memory = subparsers.add_parser("parse-memory", help="peak memory of full vs streaming auction parse")
+    parse_memory.add_argument("--scales", type=float, nargs="+", default=[1, 10])
+    concurrent_rw = subparsers.add_parser("concurrent-rw", help="reader latency while an ingest is writing")
+    concurrent_rw.add_argument("--snapshots", type=int, default=24)
+    concurrent_rw.add_argument("--readers", type=int, default=4)
+    statement_cost = subparsers.add_parser("statement-cost", help="formatted SQL vs bound parameters per row")
+    statement_cost.add_argument("--rows", type=int, default=20000)
+    pipeline = subparsers.add_parser("pipeline", help="parse + ingest throughput, compared with a stored baseline")
+    pipeline.add_argument("--scales", type=float, nargs="+", default=[1, 10, 100])
+    pipeline.add_argument("--runs", type=int, default=5)
+    pipeline.add_argument("--history-days", type=int, default=14)
+    pipeline.add_argument("--parser", choices=["stream", "full"], default="stream")
+    pipeline.add_argument("--baseline", default=_baseline_file)
+    pipeline.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    pipeline.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before failing")
+    end_to_end = subparsers.add_parser("end-to-end", help="Controller.main against the local mock API")
+    end_to_end.add_argument("--runs", type=int, default=5)
+    end_to_end.add_argument("--realms", type=int, default=4, help="connected realms, one target each")
+    end_to_end.add_argument("--scale", type=float, default=1.0, help="auctions per snapshot, x the sample")
+    end_to_end.add_argument("--latency-ms", type=float, default=20)
+    end_to_end.add_argument("--throttle-rate", type=float, default=0.01, help="share of requests answered 429")
+    end_to_end.add_argument("--item-404-rate", type=float, default=0.02, help="share of item lookups answered 404")
+    end_to_end.add_argument("--items-per-run", type=int, default=2000)
+    end_to_end.add_argument("--backfill-rate", type=float, default=200, help="item requests per second")
+    args = parser.parse_args()
+    if args.benchmark == "parse-memory":
+        benchmark_parse_memory(args.scales)
+    elif args.benchmark == "concurrent-rw":
+        benchmark_concurrent_rw(args.snapshots, args.readers)
+    elif args.benchmark == "statement-cost":
+        benchmark_statement_cost(args.rows)
+    elif args.benchmark == "pipeline":
+        results = benchmark_pipeline(args.scales, args.runs, args.history_days, args.parser)
+        if args.save_baseline:
+            if not os.path.exists(os.path.dirname(args.baseline)):
+                os.makedirs(os.path.dirname(args.baseline))
+            with open(args.baseline, 'w') as wf:
+                json.dump(results, wf, indent=2)
+            print("Saved baseline to " + args.baseline)
+        elif os.path.exists(args.baseline):
+            with open(args.baseline, 'r') as rf:
+                regressions = compare_with_baseline(results, json.load(rf), args.tolerance)
+            for regression in regressions:
+                print("REGRESSION " + regression)
+            if len(regressions) > 0:
+                sys.exit(1)
+            print("No regressions against " + args.baseline)
+        else:
+            # without a baseline nothing can be checked, which must not pass silently in CI
+            print("No baseline at {}, run with --save-baseline to store one".format(args.baseline))
+            sys.exit(1)
+    elif args.benchmark == "end-to-end":
+        benchmark_end_to_end(args.runs, args.realms, args.scale, args.latency_ms, args.throttle_rate,
+                             args.item_404_rate, args.items_per_run, args.backfill_rate)
+
+
+if __name__ == "__main__":
+    main()
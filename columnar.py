@@ -0,0 +1,51 @@
+#######################################################################################################################
+#
+#   Compact column encoding for raw auction data.  A column is a NumPy array cast to a fixed dtype and
+#   zlib-compressed, so a whole snapshot's item ids, unit prices and quantities each fit in one BLOB (or one
+#   array of an archive file) and decode straight back into arrays without per-row Python objects.
+#
+#   Column dtypes are fixed per column name in _column_dtypes: item ids and quantities fit in 32 bits,
+#   prices (copper) need 64.
+#
+#######################################################################################################################
+
+import zlib
+import numpy as np
+from auction_stats import AuctionAccumulator
+
+# global variables:
+_column_dtypes: dict = \
+    {
+        "item_id": np.int32,
+        "unit_price": np.int64,
+        "quantity": np.int32
+    }
+_compression_level: int = 1  # the fastest level already shrinks sorted id/price columns several-fold
+
+
+def cast_column(name: str, values):
+    return np.ascontiguousarray(values, dtype=_column_dtypes[name])
+
+
+def encode_column(name: str, values) -> bytes:
+    return zlib.compress(cast_column(name, values).tobytes(), _compression_level)
+
+
+def decode_column(name: str, blob: bytes):
+    return np.frombuffer(zlib.decompress(blob), dtype=_column_dtypes[name])
+
+
+def accumulator_columns(accumulator: AuctionAccumulator) -> dict:
+    return {
+        "item_id": np.frombuffer(accumulator.item_ids, dtype=np.int64),
+        "unit_price": np.rint(np.frombuffer(accumulator.unit_prices, dtype=np.float64)),
+        "quantity": np.frombuffer(accumulator.quantities, dtype=np.int64)
+    }
+
+
+def columns_to_accumulator(columns: dict) -> AuctionAccumulator:
+    accumulator = AuctionAccumulator()
+    accumulator.item_ids.frombytes(np.asarray(columns["item_id"], dtype=np.int64).tobytes())
+    accumulator.unit_prices.frombytes(np.asarray(columns["unit_price"], dtype=np.float64).tobytes())
+    accumulator.quantities.frombytes(np.asarray(columns["quantity"], dtype=np.int64).tobytes())
+    return accumulator
@@ -2,46 +2,207 @@
 #
 #   Handles interactions between the api and database gateways.  Collects current auction data,
 #   stores it in the database, then checks n items in database for missing data and attempts to
-#   fill them.  Currently fixes 100 entries per hour, if run hourly 2400 per day, resulting in
-#   a full item database in approximately a week.  While this could be done all at once, the
-#   process would take hours and valuable auction data would be missed.
+#   fill them.  Item lookups run concurrently under a rate limit (see backfill.py), so a run can
+#   resolve a few thousand items in a minute or two, after the auction snapshot has been stored.
+#   The number of items per run, the number of concurrent lookups and the request rate are set in
+#   the "backfill" section of the config file.
+#
+#   One run can collect several connected realms across regions.  The config may hold a "targets" list:
+#       "targets": [{"region": "us", "realm_id": [74, 96]}, {"region": "eu", "realm_id": [1092]}]
+#   Without it the top-level region and realm_id form the only target.  Targets are fetched concurrently,
+#   targets in the same region share one token, and the main thread is the only database writer: each
+#   snapshot is ingested as soon as its download finishes.  Per-target timings and outcomes are logged and
+#   returned by collect_and_store_data.
+#
+#   With "commodities": true in the config, the region-wide commodities auction house is collected once per
+#   region alongside the realm targets.
+#
+#   With "archive": true, every stored snapshot is also written to the raw snapshot archive (see archive.py).
+#
+#   Every run is measured (see metrics.py): start_run hands one RunMetrics object to the gateways, and
+#   finish_run writes its per-stage timings and counters to data/metrics.  The optional "metrics" section of the
+#   config file turns the record off or enables the cProfile / tracemalloc hooks.
 #
 #######################################################################################################################
 
-from api_gateway import APIGateway
+from api_gateway import APIGateway, TokenState, commodity_market_id
 from database_gateway import DatabaseGateway
+from backfill import ItemBackfill
+from archive import SnapshotArchive
+from metrics import RunMetrics
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import generic_util as gu
 import os
+import time
+
+# global variables:
+_default_backfill_config: dict = \
+    {
+        "items_per_run": 2000,
+        "concurrency": 8,
+        "requests_per_second": 100
+    }
 
 
 class Controller(object):
 
-    def __init__(self, api_config="config.json"):
+    def __init__(self, api_config="config.json", db_file: str = None):
         self.log = gu.initialize_logger("controller.py")
         self.ag = APIGateway(api_config, self.log)
-        self.ag.fetch_token()
-        self.dg = DatabaseGateway(self.log)
+        if "log_level" in self.ag.config:
+            gu.set_log_level(self.ag.config["log_level"])
+        self.gateways = build_gateways(api_config, self.ag, self.log)
+        self.ag = self.gateways[0]  # item lookups are not realm specific, the first target serves them
+        self.ag.ensure_token()
+        self.dg = DatabaseGateway(self.log, profile=self.ag.config.get("database"), db_file=db_file,
+                                  anomaly_config=self.ag.config.get("anomalies"),
+                                  retention_config=self.ag.config.get("retention"))
+        self.keep_connection = False  # set by the daemon to keep the database connection open between runs
+        self.archive = SnapshotArchive(self.log) if self.ag.config.get("archive", False) else None
+        self.backfill_config = dict(_default_backfill_config)
+        self.backfill_config.update(self.ag.config.get("backfill", {}))
+        self.metrics = None  # RunMetrics of the run in progress, see start_run
 
-    def collect_and_store_data(self):
+    def collect_and_store_data(self) -> [dict]:
         self.log.info("Module (controller.py) using (api_gateway.py)")
-        data = self.ag.gather_clean_data()
-        self.log.info("Module (controller.py) using (database_gateway.py)")
+        results = []
+        jobs = [(gateway, "realm") for gateway in self.gateways]
+        if self.ag.config.get("commodities", False):
+            jobs += [(gateway, "commodities") for gateway in first_gateway_per_region(self.gateways)]
+        snapshot_ts = gu.get_hour_timestamp()
         self.dg.start_connection()
-        self.dg.add_auction_data(data)
-        self.dg.close_connection()
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            futures = {pool.submit(collect_target, gateway, kind): (gateway, kind) for gateway, kind in jobs}
+            for future in as_completed(futures):
+                gateway, kind = futures[future]
+                name = gateway.target_name() if kind == "realm" else gateway.region + ":commodities"
+                result = {"target": name, "realm_id": gateway.realm_id}
+                try:
+                    accumulator, data, result["fetch_seconds"] = future.result()
+                except Exception as e:
+                    self.log.error("Collecting {} failed: {}".format(name, e))
+                    result.update({"status": "failed", "fetch_seconds": None, "items": 0})
+                    self.count_target("failed")
+                    results.append(result)
+                    continue
+                if kind == "commodities":
+                    result["realm_id"] = commodity_market_id(gateway.region)
+                else:
+                    result["realm_id"] = gateway.realm_id
+                if data is None:
+                    self.count_target("not_modified")
+                    self.log.info("No new auction snapshot for {}, skipping ingest (no-op)".format(name))
+                    result.update({"status": "not_modified", "items": 0})
+                    results.append(result)
+                    continue
+                self.log.info("Module (controller.py) using (database_gateway.py)")
+                start = time.perf_counter()
+                stored = len(data) > 0
+                with self.dg.metrics.stage("db_write"):
+                    if stored and kind == "commodities":
+                        stored = self.dg.add_commodity_snapshot(gateway.region, accumulator, snapshot_ts=snapshot_ts)
+                    stored = stored and self.dg.add_auction_data(data, realm_id=result["realm_id"],
+                                                                 snapshot_ts=snapshot_ts)
+                if stored and self.archive is not None:
+                    with self.dg.metrics.stage("archive"):
+                        self.archive.write(result["realm_id"], snapshot_ts, accumulator)
+                result["ingest_seconds"] = round(time.perf_counter() - start, 3)
+                if stored:
+                    gateway.save_snapshot_validators("commodities" if kind == "commodities" else None)
+                result.update({"status": "ok" if stored else "failed", "items": len(data)})
+                self.count_target(result["status"])
+                results.append(result)
+        self.release_connection()
+        for result in results:
+            self.log.info("Target {target} (realm {realm_id}): {status}, {items} items, fetch {fetch_seconds}s, "
+                          "ingest {ingest}s".format(ingest=result.get("ingest_seconds"), **result))
+        return results
 
-    def fix_unnamed_items(self, fix_num: int = 100):
+    def fix_unnamed_items(self, fix_num: int = None) -> int:
+        if fix_num is None:
+            fix_num = self.backfill_config["items_per_run"]
         self.dg.start_connection()
-        item_rows = self.dg.find_items_missing_data(fix_num)
-        items = []
-        for item in item_rows:
-            items.append(item[0])
-        for item in items:
-            item_data = (self.ag.fetch_item_data(item))
-            self.dg.update_item_data(item_id=item, item_name=item_data["name"], item_quality=item_data["quality"])
-        self.dg.close_connection()
-
-    def main(self):
-        self.collect_and_store_data()
-        self.fix_unnamed_items()
+        backfill = ItemBackfill(self.ag, self.dg, self.log,
+                                concurrency=self.backfill_config["concurrency"],
+                                requests_per_second=self.backfill_config["requests_per_second"])
+        with self.dg.metrics.stage("backfill"):
+            fixed = backfill.run(fix_num)
+        self.dg.metrics.count("items_backfilled", fixed)
+        self.release_connection()
+        return fixed
+
+    def release_connection(self):
+        if not self.keep_connection:
+            self.dg.close_connection()
+
+    def start_run(self) -> RunMetrics:
+        # finishes the record of a run still in progress, then measures a new one
+        self.finish_run()
+        self.metrics = RunMetrics(self.log, self.ag.config.get("metrics"))
+        for gateway in self.gateways:
+            gateway.metrics = self.metrics
+        self.dg.metrics = self.metrics
+        self.metrics.start()
+        return self.metrics
+
+    def finish_run(self) -> dict:
+        if self.metrics is None:
+            return {}
+        record = self.metrics.finish()
+        self.metrics = None
+        return record
+
+    def count_target(self, status: str):
+        self.dg.metrics.count("targets_" + status)
+
+    def main(self) -> dict:
+        # returns the metrics record of the run
+        self.start_run()
+        try:
+            self.collect_and_store_data()
+            self.fix_unnamed_items()
+        finally:
+            record = self.finish_run()
+        return record
+
+
+def collect_target(gateway: APIGateway, kind: str = "realm") -> (object, dict, float):
+    # returns the raw AuctionAccumulator and its cleaned data (both None when unchanged), aggregated here
+    # so the work runs on the fetching thread instead of the single writer
+    start = time.perf_counter()
+    if kind == "commodities":
+        accumulator = gateway.gather_commodity_data()
+    else:
+        accumulator = gateway.gather_auction_data()
+    data = None
+    if accumulator is not None:
+        with gateway.metrics.stage("clean"):
+            data = accumulator.summarize()
+    return accumulator, data, round(time.perf_counter() - start, 3)
+
+
+def first_gateway_per_region(gateways: [APIGateway]) -> [APIGateway]:
+    by_region = {}
+    for gateway in gateways:
+        by_region.setdefault(gateway.region, gateway)
+    return list(by_region.values())
+
 
+def build_gateways(config_file: str, base_gateway: APIGateway, logger) -> [APIGateway]:
+    targets = base_gateway.config.get("targets")
+    if not targets:
+        return [base_gateway]
+    token_states = {}
+    gateways = []
+    for target in targets:
+        region = target.get("region", base_gateway.region)
+        if len(gateways) == 0:
+            # the gateway that read the config, and its session, serves the first target
+            base_gateway.load_target(target)
+            token_states[region] = base_gateway.token_state
+            gateways.append(base_gateway)
+            continue
+        if region not in token_states:
+            token_states[region] = TokenState()
+        gateways.append(APIGateway(config_file, logger, target=target, token_state=token_states[region]))
+    return gateways
@@ -5,13 +5,17 @@
 #
 #   Uses SQLite to avoid server connections for portability reasons.
 #
-#   For add_auction_data, data is expected in json (dict) format:
+#   For add_auction_data, data is expected in json (dict) format, as produced by auction_stats.py:
 #   {
 #       <item_id>:
 #           {
-#               "buyout" : <buyout_price>
-#               "quantity" : <quantity>
-#               "unit_price" : <unit_price>
+#               "min_price" : <lowest unit price>
+#               "median_price" : <median unit price>
+#               "mean_price" : <mean unit price>
+#               "p10_price" : <10th percentile unit price>
+#               "p90_price" : <90th percentile unit price>
+#               "quantity" : <total quantity listed>
+#               "listings" : <number of auctions>
 #           },
 #       <item_id>:
 #           {
@@ -21,70 +25,468 @@
 #   }
 #   Alternatively, a single item_id and price can be provided separately with check_listing_table.
 #
+#   Listings are stored in long format, one row per (item_id, realm_id, snapshot_ts), where snapshot_ts is the
+#   unix timestamp of the hour the snapshot was collected in.  The composite primary key doubles as the index
+#   (WITHOUT ROWID), so the history of one item over any time range is a single index range scan.
+#
+#   add_auction_data writes a whole snapshot inside a single transaction, using executemany with UPSERT
+#   statements for both item_names and the listings table.  The rows/sec figure is logged at the end.
+#
+#   Each ingest also updates the rollup tables rollup_daily and rollup_weekly: per item, realm and period they
+#   keep the minimum, maximum and sum of the hourly minimum price, the number of snapshots and the listed volume,
+#   so charts over long ranges read one row per day or week instead of every hourly row (see price_history.py).
+#   The snapshots table records every ingested (realm_id, snapshot_ts); when a snapshot is ingested again the
+#   affected rollup rows are rebuilt from listings instead of being counted twice.
+#
+#   Ingest also scores each item's minimum price against its running statistics (see anomaly.py): the state
+#   per item and realm is kept in price_state and items whose price deviates beyond the threshold are recorded
+#   in price_alerts, both written in the snapshot's transaction.  price_alerts(realm_id, snapshot_ts) reads the
+#   flags back, cheapest deals first; rebuild_price_state recomputes state and flags from listings.  Settings
+#   come from the "anomalies" section of the config file.
+#
+#   Hourly listings older than the hot window live in monthly shard files (see shards.py, self.shards).  A
+#   snapshot that old is written to its month's shard rather than the main file, and the rebuilds (repeat
+#   snapshot rollups, rebuild_rollups, rebuild_price_state) read the shards, archived ones included, as well.
+#
+#   Raw commodity auctions are kept per region and snapshot in commodity_snapshots, one row per snapshot with
+#   the item_id, unit_price and quantity columns stored as compressed arrays (see columnar.py).  Like hourly
+#   listings, snapshots older than the hot window move into the monthly shards.
+#
+#   Connections are opened with a configurable profile (the "database" section of the config file, defaults in
+#   _default_profile): WAL journaling so readers never block the writer or each other, synchronous=NORMAL
+#   (safe with WAL, one fsync per checkpoint instead of per commit), a larger page cache, memory-mapped reads
+#   and a busy timeout.  Dashboards and other readers should use DatabaseGateway(read_only=True), which opens
+#   the file read-only and never creates tables.
+#
+#   The ids already in item_names are loaded into a set once per connection (kept for as long as the connection
+#   is, so across runs in daemon mode), and ingest only inserts the ids missing from it, in bulk.  A repeat
+#   ingest of known items runs no item_names statements at all.
+#
+#   Every statement binds its values as parameters, so its SQL text never changes between calls and SQLite's
+#   prepared-statement cache (sized by "cached_statements" in the profile) is hit instead of re-parsing.
+#   Only table and column names, which are fixed in this module, are formatted into the SQL.
+#
+#   export_parquet writes listings and item names to partitioned Parquet files for analysis, incrementally
+#   (see parquet_export.py, "python . --export").
+#
+#   Databases created before the long format hold weekly_listings_<week> tables (24 price_at_hour_N columns)
+#   and item_price_stats.  migrate_legacy_tables copies them into listings; run it with "python . --migrate".
+#
 #######################################################################################################################
 
+import json
 import sqlite3
 import generic_util as gu
+from auction_stats import AuctionAccumulator
+import columnar
+from metrics import RunMetrics
+from anomaly import AnomalyDetector
+from parquet_export import ParquetExporter
+from shards import ShardManager
 import os
-# remove after testing:
-import json
+import time
 
 # global variables:
 _db_path: str = os.path.join(os.path.dirname(__file__), "data", "database")
 _db_name: str = "ah_database.db"
 _log_filename: str = "db_gateway"
-_listings: str = "weekly_listings_{}".format(gu.get_week())
+_default_profile: dict = \
+    {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,  # negative values are KiB, so 64 MiB
+        "mmap_size": 268435456,
+        "busy_timeout": 10000,  # milliseconds
+        "cached_statements": 256,
+        "auto_vacuum": "INCREMENTAL"  # only takes effect on a new database file
+    }
+_listings: str = "listings"
 _item_names: str = "item_names"
-_sales_hour: str = "price_at_hour_"
+_stat_columns: [str] = ["min_price", "median_price", "mean_price", "p10_price", "p90_price", "quantity", "listings"]
+_snapshots: str = "snapshots"
+_commodity_snapshots: str = "commodity_snapshots"
+_commodity_columns: [str] = ["item_id", "unit_price", "quantity"]
+_rollups: dict = \
+    {
+        "daily": "rollup_daily",
+        "weekly": "rollup_weekly"
+    }
+_rollup_columns: [str] = ["min_price", "max_price", "price_sum", "samples", "volume"]
+_shards: str = "shards"
+_price_state: str = "price_state"
+_price_alerts: str = "price_alerts"
+_legacy_listings_prefix: str = "weekly_listings_"
+_legacy_price_stats: str = "item_price_stats"
+_legacy_sales_hour: str = "price_at_hour_"
 _tables: dict = \
     {
         _listings: {
             "name": _listings,
-            "columns": ["item_id INTEGER PRIMARY KEY", "year INTEGER NOT NULL", "day_in_year INTEGER NOT NULL"],
-            "constraints": []
+            "columns": ["item_id INTEGER NOT NULL", "realm_id INTEGER NOT NULL", "snapshot_ts INTEGER NOT NULL"] +
+                       ["{} INTEGER".format(column) for column in _stat_columns],
+            "constraints": ["PRIMARY KEY (item_id, realm_id, snapshot_ts)"],
+            "options": "WITHOUT ROWID"
         },
         _item_names: {
             "name": _item_names,
             "columns": ["item_id INTEGER", "item_name TEXT DEFAULT 'UNDEFINED'",
                         "item_quality TEXT DEFAULT 'UNDEFINED'"],
             "constraints": ["CONSTRAINT item_id FOREIGN KEY (item_id) REFERENCES listings (item_id)"]
+        },
+        _snapshots: {
+            "name": _snapshots,
+            "columns": ["realm_id INTEGER NOT NULL", "snapshot_ts INTEGER NOT NULL", "item_count INTEGER",
+                        "ingested_at INTEGER"],
+            "constraints": ["PRIMARY KEY (realm_id, snapshot_ts)"]
+        },
+        _commodity_snapshots: {
+            "name": _commodity_snapshots,
+            "columns": ["region TEXT NOT NULL", "snapshot_ts INTEGER NOT NULL", "auction_count INTEGER"] +
+                       ["{}_column BLOB".format(column) for column in _commodity_columns],
+            "constraints": ["PRIMARY KEY (region, snapshot_ts)"]
+        },
+        _shards: {
+            "name": _shards,
+            "columns": ["period TEXT NOT NULL", "file_name TEXT", "start_ts INTEGER", "end_ts INTEGER",
+                        "row_count INTEGER", "state TEXT", "updated_at INTEGER"],
+            "constraints": ["PRIMARY KEY (period)"]
+        },
+        _price_state: {
+            "name": _price_state,
+            "columns": ["item_id INTEGER NOT NULL", "realm_id INTEGER NOT NULL", "mean REAL", "var REAL",
+                        "samples INTEGER", "last_ts INTEGER"],
+            "constraints": ["PRIMARY KEY (realm_id, item_id)"],
+            "options": "WITHOUT ROWID"
+        },
+        _price_alerts: {
+            "name": _price_alerts,
+            "columns": ["item_id INTEGER NOT NULL", "realm_id INTEGER NOT NULL", "snapshot_ts INTEGER NOT NULL",
+                        "price INTEGER", "expected_price INTEGER", "z_score REAL"],
+            "constraints": ["PRIMARY KEY (realm_id, snapshot_ts, item_id)"],
+            "options": "WITHOUT ROWID"
         }
 }
-for x in range(0,24):
-    _tables[_listings]["columns"].append("{}{} INTEGER DEFAULT -1".format(_sales_hour, x))
+for _rollup in _rollups.values():
+    _tables[_rollup] = {
+        "name": _rollup,
+        "columns": ["item_id INTEGER NOT NULL", "realm_id INTEGER NOT NULL", "period_ts INTEGER NOT NULL"] +
+                   ["{} INTEGER".format(column) for column in _rollup_columns],
+        "constraints": ["PRIMARY KEY (item_id, realm_id, period_ts)"],
+        "options": "WITHOUT ROWID"
+    }
+_listings_index: str = "CREATE INDEX IF NOT EXISTS {}idx_listings_realm_snapshot ON {} (realm_id, snapshot_ts)"
+_indexes: dict = \
+    {
+        _item_names: ["CREATE UNIQUE INDEX IF NOT EXISTS idx_item_names_item_id ON {} (item_id)".format(_item_names)],
+        # time-range reads of one realm (export, rebuilds) without scanning every item
+        _listings: [_listings_index.format("", _listings)]
+    }
+_statements: dict = \
+    {
+        "known_items": "SELECT item_id FROM {}".format(_item_names),
+        "insert_item": "INSERT INTO {} (item_id) VALUES (?) ON CONFLICT(item_id) DO NOTHING".format(_item_names),
+        "upsert_listing_price": "INSERT INTO {} (item_id, realm_id, snapshot_ts, min_price) VALUES (?, ?, ?, ?) "
+                                "ON CONFLICT(item_id, realm_id, snapshot_ts) DO UPDATE SET "
+                                "min_price = excluded.min_price".format(_listings),
+        "items_missing_data": "SELECT * FROM {} WHERE item_name = ? OR item_quality = ? LIMIT ?".format(_item_names),
+        "update_item": "UPDATE {} SET item_name = ?, item_quality = ? WHERE item_id = ?".format(_item_names),
+        "table_names_like": "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?",
+        "index_names": "SELECT name FROM sqlite_master WHERE type = 'index'",
+        "load_price_state": "SELECT item_id, mean, var, samples, last_ts FROM {} WHERE realm_id = ?".format(
+            _price_state),
+        "upsert_price_state": "INSERT OR REPLACE INTO {} (item_id, realm_id, mean, var, samples, last_ts) "
+                              "VALUES (?, ?, ?, ?, ?, ?)".format(_price_state),
+        "insert_price_alert": "INSERT OR REPLACE INTO {} (item_id, realm_id, snapshot_ts, price, expected_price, "
+                              "z_score) VALUES (?, ?, ?, ?, ?, ?)".format(_price_alerts),
+        "price_alerts": "SELECT item_id, price, expected_price, z_score FROM {} WHERE realm_id = ? "
+                        "AND snapshot_ts = ? ORDER BY z_score".format(_price_alerts),
+        "price_state_realms": "SELECT DISTINCT realm_id FROM {}".format(_snapshots),
+        "clear_price_state": "DELETE FROM {} WHERE realm_id = ?".format(_price_state),
+        "clear_price_alerts": "DELETE FROM {} WHERE realm_id = ?".format(_price_alerts),
+        # formatted with the schema of the main database or a shard, see shards.py
+        "realm_min_prices": "SELECT snapshot_ts, item_id, min_price FROM {{}}.{} WHERE realm_id = ? "
+                            "AND snapshot_ts >= ? AND snapshot_ts < ? ORDER BY snapshot_ts".format(_listings),
+        "rollup_groups": "SELECT item_id, MIN(min_price), MAX(min_price), SUM(min_price), COUNT(min_price), "
+                         "SUM(quantity) FROM {{}}.{} WHERE realm_id = ? AND snapshot_ts >= ? AND snapshot_ts < ? "
+                         "{{}}GROUP BY item_id".format(_listings)
+    }
 
 
 class DatabaseGateway(object):
 
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, profile: dict = None, read_only: bool = False, db_file: str = None,
+                 anomaly_config: dict = None, retention_config: dict = None):
         if logger is not None:
             self.log = logger
         else:
             self.log = gu.initialize_logger("database_gateway.py")
+        self.profile = dict(_default_profile)
+        self.profile.update(profile or {})
+        self.read_only = read_only
+        self.db_file = db_file if db_file is not None else os.path.join(_db_path, _db_name)
         self.today = gu.get_year_day()
         self.conn = None  # database connection
         self.cursor = None  # sqlite cursor
+        self.tables_created = False  # schema DDL only needs to run once per process
+        self.known_items = None  # item ids in item_names, loaded on first use per connection
+        self.metrics = RunMetrics()  # replaced by the controller's metrics for each run
+        self.anomalies = AnomalyDetector(anomaly_config)  # price state is loaded per realm on first use
+        self.shards = ShardManager(self, retention_config=retention_config)  # listings older than the hot window
+
+    def add_auction_data(self, sales_data: dict, realm_id: int = 0, snapshot_ts: int = None) -> bool:
+        if not self.check_connection("add data to " + _listings):
+            return False
+        if snapshot_ts is None:
+            snapshot_ts = gu.get_hour_timestamp()
+        known_items = self.load_known_items()
+        new_items = set()
+        listing_rows = []
+        for item_id in sales_data.keys():
+            stats = sales_data[item_id]
+            if int(item_id) not in known_items:
+                new_items.add(int(item_id))
+            listing_rows.append((int(item_id), realm_id, snapshot_ts) +
+                                tuple(stats[column] for column in _stat_columns))
+        item_statement = _statements["insert_item"]
+        cold_month = self.shards.cold_month(snapshot_ts)  # older snapshots are written to their month's shard
+        listings_table = _listings if cold_month is None else self.shards.listings_table()
+        listing_statement = "INSERT INTO {} (item_id, realm_id, snapshot_ts, {}) VALUES (?, ?, ?, {}) " \
+                            "ON CONFLICT(item_id, realm_id, snapshot_ts) DO UPDATE SET {}".format(
+                                listings_table, ", ".join(_stat_columns), ", ".join("?" for _ in _stat_columns),
+                                ", ".join("{0} = excluded.{0}".format(column) for column in _stat_columns)
+                            )
+        snapshot_statement = "INSERT OR REPLACE INTO {} (realm_id, snapshot_ts, item_count, ingested_at) " \
+                             "VALUES (?, ?, ?, ?)".format(_snapshots)
+        start = time.perf_counter()
+        repeated = self.snapshot_exists(realm_id, snapshot_ts)
+        batches = [(listing_statement, listing_rows),
+                   (snapshot_statement, [(realm_id, snapshot_ts, len(listing_rows), int(time.time()))])]
+        if len(new_items) > 0:
+            batches.insert(0, (item_statement, [(item_id,) for item_id in sorted(new_items)]))
+        if not repeated:
+            for period, rollup in _rollups.items():
+                period_ts = gu.get_period_start(snapshot_ts, period)
+                rollup_rows = [(row[0], realm_id, period_ts, row[3], row[3], row[3], row[8]) for row in listing_rows]
+                batches.append((rollup_upsert_statement(rollup), rollup_rows))
+        price_state = None
+        alert_rows = []
+        if self.anomalies.enabled and not repeated:
+            self.load_price_state(realm_id)
+            price_state, state_rows, alert_rows = self.anomalies.observe(
+                realm_id, snapshot_ts, [row[0] for row in listing_rows], [row[3] for row in listing_rows])
+            batches += [(_statements["upsert_price_state"], state_rows),
+                        (_statements["insert_price_alert"], alert_rows)]
+        if cold_month is not None:
+            if self.shards.has_listings(realm_id, cold_month):
+                self.shards.move_month(cold_month, [realm_id])  # keeps the realm's month in one file
+            self.shards.attach_month(cold_month)
+            statement, params = self.shards.catalog_update(cold_month, 0 if repeated else len(listing_rows))
+            batches.append((statement, [params]))
+        try:
+            stored = self.execute_many(batches)
+        finally:
+            if cold_month is not None:
+                self.shards.detach()
+        if not stored:
+            return False
+        known_items.update(new_items)  # only once the transaction committed
+        if price_state is not None:
+            self.anomalies.commit(realm_id, price_state)
+            if len(alert_rows) > 0:
+                self.log.info("Flagged {} price anomalies in snapshot {} for realm {}".format(
+                    len(alert_rows), snapshot_ts, realm_id))
+        self.metrics.gauge("known_items", len(known_items))
+        if repeated:
+            self.log.info("Snapshot {} for realm {} was ingested before, rebuilding its rollups".format(
+                snapshot_ts, realm_id))
+            self.rebuild_rollups(realm_id, snapshot_ts, snapshot_ts + 1, item_ids=[row[0] for row in listing_rows])
+        elapsed = time.perf_counter() - start
+        row_count = sum(len(rows) for statement, rows in batches)
+        rate = row_count / elapsed if elapsed > 0 else float(row_count)
+        self.metrics.count("items", len(listing_rows))
+        self.metrics.count("new_items", len(new_items))
+        self.metrics.count("rows", row_count)
+        self.log.info("Ingested {} items, {} new ({} rows) in {:.3f}s: {:.0f} rows/sec".format(
+            len(listing_rows), len(new_items), row_count, elapsed, rate)
+        )
+        return True
+
+    def add_commodity_snapshot(self, region: str, accumulator: AuctionAccumulator, snapshot_ts: int = None) -> bool:
+        # stores the raw commodity auctions as three compressed columns in a single row
+        if not self.check_connection("add data to " + _commodity_snapshots):
+            return False
+        if snapshot_ts is None:
+            snapshot_ts = gu.get_hour_timestamp()
+        start = time.perf_counter()
+        columns = columnar.accumulator_columns(accumulator)
+        row = (region, snapshot_ts, len(accumulator)) + tuple(
+            columnar.encode_column(column, columns[column]) for column in _commodity_columns)
+        cold_month = self.shards.cold_month(snapshot_ts)  # older snapshots are written to their month's shard
+        table = _commodity_snapshots if cold_month is None else self.shards.commodities_table()
+        statement = "INSERT OR REPLACE INTO {} (region, snapshot_ts, auction_count, {}) " \
+                    "VALUES (?, ?, ?, ?, ?, ?)".format(
+                        table, ", ".join("{}_column".format(column) for column in _commodity_columns))
+        batches = [(statement, [row])]
+        if cold_month is not None:
+            if self.shards.has_commodities(cold_month):
+                self.shards.move_month(cold_month, [])  # keeps the month's commodity snapshots in one file
+            self.shards.attach_month(cold_month)
+            stored_before = self.conn.execute("SELECT 1 FROM {} WHERE region = ? AND snapshot_ts = ?".format(
+                table), (region, snapshot_ts)).fetchone() is not None
+            statement, params = self.shards.catalog_update(cold_month, 0 if stored_before else 1)
+            batches.append((statement, [params]))
+        try:
+            stored = self.execute_many(batches)
+        finally:
+            if cold_month is not None:
+                self.shards.detach()
+        if not stored:
+            return False
+        self.metrics.count("rows")
+        self.log.info("Stored {} commodity auctions ({:.1f} MB compressed) in {:.3f}s".format(
+            len(accumulator), sum(len(blob) for blob in row[3:]) / 1e6, time.perf_counter() - start))
+        return True
+
+    def load_commodity_snapshot(self, region: str, snapshot_ts: int) -> dict:
+        # returns the item_id, unit_price and quantity arrays of one stored commodity snapshot, which may have
+        # been moved into a shard
+        statement = "SELECT {} FROM {{}}.{} WHERE region = ? AND snapshot_ts = ?".format(
+            ", ".join("{}_column".format(column) for column in _commodity_columns), _commodity_snapshots)
+        try:
+            rows = self.shards.query_listings(statement, (region, snapshot_ts), snapshot_ts, snapshot_ts + 1,
+                                              include_archived=True)
+        finally:
+            self.shards.release_unpacked()
+        if len(rows) == 0:
+            return {}
+        row = rows[0]
+        return {column: columnar.decode_column(column, row[i]) for i, column in enumerate(_commodity_columns)}
+
+    def snapshot_exists(self, realm_id: int, snapshot_ts: int) -> bool:
+        statement = "SELECT 1 FROM {} WHERE realm_id = ? AND snapshot_ts = ?".format(_snapshots)
+        return self.conn.execute(statement, (realm_id, snapshot_ts)).fetchone() is not None
+
+    def rebuild_rollups(self, realm_id: int, start_ts: int, end_ts: int, item_ids: list = None) -> bool:
+        # recomputes every daily and weekly rollup row touching [start_ts, end_ts) from listings, in the main
+        # file and in the shards (archived ones included); with item_ids only those items are regrouped
+        if not self.check_connection("rebuild rollups"):
+            return False
+        if item_ids is None:
+            statement = _statements["rollup_groups"].format("{}", "")
+            item_param = ()
+        else:
+            statement = _statements["rollup_groups"].format("{}", "AND item_id IN (SELECT value FROM json_each(?)) ")
+            item_param = (json.dumps([int(item_id) for item_id in item_ids]),)
+        batches = []
+        try:
+            for period, rollup in _rollups.items():
+                period_ts = gu.get_period_start(start_ts, period)
+                while period_ts < end_ts:
+                    period_end = gu.get_period_end(period_ts, period)
+                    groups = self.shards.query_listings(statement, (realm_id, period_ts, period_end) + item_param,
+                                                        period_ts, period_end, include_archived=True)
+                    insert = "INSERT OR REPLACE INTO {} (item_id, realm_id, period_ts, {}) " \
+                             "VALUES (?, ?, ?, ?, ?, ?, ?, ?)".format(rollup, ", ".join(_rollup_columns))
+                    batches.append((insert, [(item_id, realm_id, period_ts) + values
+                                             for item_id, values in merge_rollup_groups(groups).items()]))
+                    period_ts = period_end
+        finally:
+            self.shards.release_unpacked()
+        return self.execute_many(batches)
+
+    def load_price_state(self, realm_id: int):
+        if not self.anomalies.has_state(realm_id):
+            self.anomalies.load_state(realm_id, self.conn.execute(_statements["load_price_state"],
+                                                                  (realm_id,)).fetchall())
+
+    def price_alerts(self, realm_id: int, snapshot_ts: int) -> list:
+        # (item_id, price, expected_price, z_score) rows flagged in one snapshot, most underpriced first
+        if not self.check_connection("read " + _price_alerts):
+            return []
+        return self.conn.execute(_statements["price_alerts"], (realm_id, snapshot_ts)).fetchall()
 
-    def add_auction_data(self, sales_data: dict):
-        if self.check_connection("add data to " + _item_names):
-            for item_id in sales_data.keys():
-                self.check_item_table(item_id)
-        if self.check_connection("add data to " + _listings):
-            for item_id in sales_data.keys():
-                sales_this_hour = sales_data[item_id]["buyout"]
-                if sales_this_hour == "NONE":
-                    sales_this_hour = sales_data[item_id]["unit_price"]
-                self.check_listing_table(item_id, sales_this_hour)
+    def rebuild_price_state(self, realm_id: int = None) -> int:
+        # replays the stored minimum prices of a realm (default: every realm) in time order, replacing its
+        # price_state and price_alerts rows, returns the number of alerts
+        if not self.check_connection("rebuild " + _price_state):
+            return 0
+        if realm_id is None:
+            realm_ids = [row[0] for row in self.conn.execute(_statements["price_state_realms"])]
+        else:
+            realm_ids = [realm_id]
+        start = time.perf_counter()
+        alert_count = 0
+        for realm in realm_ids:
+            self.anomalies.load_state(realm, [])
+            alert_rows = []
+            snapshot_ts = None
+            item_ids = []
+            prices = []
+            # month by month, so the shard months (oldest) and the main file are replayed in time order
+            for month_start, month_end in self.snapshot_months(realm):
+                for rows in self.shards.listing_chunks(_statements["realm_min_prices"], (realm, month_start, month_end),
+                                                       month_start, month_end, include_archived=True):
+                    for row_ts, item_id, price in rows:
+                        if row_ts != snapshot_ts and snapshot_ts is not None:
+                            alert_rows += self.replay_price_snapshot(realm, snapshot_ts, item_ids, prices)
+                            item_ids = []
+                            prices = []
+                        snapshot_ts = row_ts
+                        item_ids.append(item_id)
+                        prices.append(price if price is not None else 0)
+            self.shards.release_unpacked()
+            if snapshot_ts is not None:
+                alert_rows += self.replay_price_snapshot(realm, snapshot_ts, item_ids, prices)
+            if not self.execute_many([(_statements["clear_price_state"], [(realm,)]),
+                                      (_statements["clear_price_alerts"], [(realm,)]),
+                                      (_statements["upsert_price_state"], self.anomalies.state_rows(realm)),
+                                      (_statements["insert_price_alert"], alert_rows)]):
+                self.anomalies.clear()  # reloaded from the stored state on the next ingest
+                return alert_count
+            alert_count += len(alert_rows)
+        self.log.info("Rebuilt price state for {} realms ({} alerts) in {:.2f}s".format(
+            len(realm_ids), alert_count, time.perf_counter() - start))
+        return alert_count
+
+    def snapshot_months(self, realm_id: int) -> list:
+        # [(month_start, month_end), ...] from the realm's first stored snapshot to its last
+        first_ts, last_ts = self.conn.execute("SELECT MIN(snapshot_ts), MAX(snapshot_ts) FROM {} "
+                                              "WHERE realm_id = ?".format(_snapshots), (realm_id,)).fetchone()
+        months = []
+        month_start = gu.get_period_start(first_ts, "monthly") if first_ts is not None else None
+        while month_start is not None and month_start <= last_ts:
+            months.append((month_start, gu.get_period_end(month_start, "monthly")))
+            month_start = months[-1][1]
+        return months
+
+    def replay_price_snapshot(self, realm_id: int, snapshot_ts: int, item_ids: list, prices: list) -> list:
+        price_state, state_rows, alert_rows = self.anomalies.observe(realm_id, snapshot_ts, item_ids, prices)
+        self.anomalies.commit(realm_id, price_state)
+        return alert_rows
+
+    def export_parquet(self, export_path: str = None, full: bool = False) -> int:
+        # writes listings and item names to partitioned Parquet files (see parquet_export.py), needs pyarrow
+        if not self.check_connection("export " + _listings):
+            return 0
+        if export_path is None:
+            return ParquetExporter(self, self.log).export(full=full)
+        return ParquetExporter(self, self.log, export_path=export_path).export(full=full)
 
     def connect_to_db(self):
         try:
             time = "TIME: " + gu.get_timestamp()
-            if not os.path.exists(_db_path):
-                os.makedirs(_db_path)
-            db = os.path.join(_db_path, _db_name)
-            db = os.path.normpath(db)
-            self.conn = sqlite3.connect(db)
+            db = os.path.normpath(self.db_file)
+            if not os.path.exists(os.path.dirname(db)):
+                os.makedirs(os.path.dirname(db))
+            timeout = self.profile["busy_timeout"] / 1000.0
+            if self.read_only:
+                self.conn = sqlite3.connect("file:{}?mode=ro".format(db), uri=True, timeout=timeout,
+                                            check_same_thread=False,
+                                            cached_statements=self.profile["cached_statements"])
+            else:
+                self.conn = sqlite3.connect(db, timeout=timeout, cached_statements=self.profile["cached_statements"])
             self.cursor = self.conn.cursor()
+            self.apply_profile()
             self.log.info("###################### DATABASE ACCESS START ######################")
             self.log.info(time)
         except Exception as e:
@@ -92,30 +494,49 @@ class DatabaseGateway(object):
             self.log.error(time)
             self.log.error("Exception: " + str(e))
 
+    def apply_profile(self):
+        pragmas = ["busy_timeout = {}".format(int(self.profile["busy_timeout"])),
+                   "cache_size = {}".format(int(self.profile["cache_size"])),
+                   "mmap_size = {}".format(int(self.profile["mmap_size"]))]
+        if not self.read_only:
+            # the journal mode is stored in the database file, so only the writer sets it
+            pragmas += ["auto_vacuum = {}".format(self.profile["auto_vacuum"]),
+                        "journal_mode = {}".format(self.profile["journal_mode"]),
+                        "synchronous = {}".format(self.profile["synchronous"])]
+        for pragma in pragmas:
+            self.conn.execute("PRAGMA " + pragma)
+
     def close_connection(self):
         if self.check_connection("close connection to " + _listings):
             self.log.info("TIME: {}".format(gu.get_timestamp()))
             self.log.info("####################### DATABASE ACCESS END #######################")
             self.conn.close()
+            self.conn = None
+            self.cursor = None
+            self.known_items = None
+            self.anomalies.clear()
+            self.shards.release_unpacked()
 
     def create_tables(self):
         if self.check_connection("create tables"):
             self.log.info("Creating tables if they don't exist:")
-            create = "CREATE TABLE IF NOT EXISTS {}"
             for table_data in _tables.keys():
-                statement = create.format(_tables[table_data]["name"])
-                count = 0
-                for column in _tables[table_data]["columns"]:
-                    if count == 0:  # need the first column to have an open parenthesis
-                        statement += " ("
-                        count += 1
-                    else:  # the rest of the columns are comma-separated
-                        statement += ", "
-                    statement += column
-                for constraint in _tables[table_data]["constraints"]:
-                    statement += ", " + constraint
-                statement += ")"  # statement ends with closed parenthesis either after columns or constraints
-                self.execute_statement(statement, log_statement=True)
+                self.execute_statement(create_table_statement(table_data), log_statement=True)
+            self.execute_statement(_statements["index_names"])
+            existing_indexes = [row[0] for row in self.cursor.fetchall()]
+            if "idx_item_names_item_id" not in existing_indexes:
+                # databases created before the unique index may hold duplicate item ids, which would block it
+                self.execute_statement("DELETE FROM {0} WHERE rowid NOT IN "
+                                       "(SELECT MIN(rowid) FROM {0} GROUP BY item_id)".format(_item_names))
+            for table_name in _indexes.keys():
+                for statement in _indexes[table_name]:
+                    self.execute_statement(statement, log_statement=True)
+
+    def create_shard_tables(self, schema: str):
+        # listings, its index and commodity_snapshots in an attached database, see shards.py
+        self.conn.execute(create_table_statement(_listings, schema=schema))
+        self.conn.execute(_listings_index.format(schema + ".", _listings))
+        self.conn.execute(create_table_statement(_commodity_snapshots, schema=schema))
 
     def check_connection(self, message: str) -> bool:
         if self.conn is None or self.cursor is None:
@@ -125,72 +546,170 @@ class DatabaseGateway(object):
             return False
         return True
 
-    def execute_statement(self, statement: str, log_statement=False) -> bool:
+    def execute_statement(self, statement: str, params=(), log_statement=False) -> bool:
         try:
             if log_statement:
-                self.log.info("Executing statement: ")
-                self.log.info(statement)
-            self.cursor.execute(statement)
+                self.log.debug("Executing statement: ")
+                self.log.debug(statement)
+            self.cursor.execute(statement, params)
             self.conn.commit()
             return True
         except Exception as e:
             if not log_statement:
                 self.log.info("Executing statement: ")  # If we didn't already log the statement,
                 self.log.info(statement)                # do it now.
+            if len(params) > 0:
+                self.log.info("With parameters: " + str(params))
             self.log.error("Statement failed due to: ")
             self.log.error(e)
             return False
 
+    def execute_many(self, batches: list) -> bool:
+        # batches is a list of (statement, rows) tuples, all committed together or not at all
+        try:
+            with self.conn:
+                for statement, rows in batches:
+                    self.cursor.executemany(statement, rows)
+            return True
+        except Exception as e:
+            for statement, rows in batches:
+                self.log.info("Executing batched statement ({} rows): ".format(len(rows)))
+                self.log.info(statement)
+            self.log.error("Batch failed and was rolled back due to: ")
+            self.log.error(e)
+            return False
+
+    def load_known_items(self) -> set:
+        if self.known_items is None:
+            self.cursor.execute(_statements["known_items"])
+            self.known_items = set(row[0] for row in self.cursor.fetchall())
+            self.log.info("Loaded {} known item ids".format(len(self.known_items)))
+            self.metrics.gauge("known_items", len(self.known_items))
+        return self.known_items
+
     def check_item_table(self, item_id: int):
-        if self.check_connection("access " + _item_names):
-            statement = "SELECT * FROM {} WHERE item_id={}".format(
-                _tables[_item_names]["name"], str(item_id)
-            )
-            if self.execute_statement(statement):
-                if len(self.cursor.fetchall()) < 1:
-                    statement = "INSERT INTO {} (item_id) VALUES ({})".format(
-                        _tables[_item_names]["name"], str(item_id)
-                    )
-                    self.execute_statement(statement)
-
-    def check_listing_table(self, item_id: int, sales: int):
+        if self.check_connection("access " + _item_names) and int(item_id) not in self.load_known_items():
+            if self.execute_statement(_statements["insert_item"], (int(item_id),)):
+                self.known_items.add(int(item_id))
+
+    def check_listing_table(self, item_id: int, sales: int, realm_id: int = 0):
         if self.check_connection("access " + _listings):
-            year = gu.get_year()
-            day = gu.get_day()
-            hour = gu.get_hour()
-            statement = "SELECT * FROM {} WHERE item_id={} AND year={} AND day_in_year={}".format(
-                _tables[_listings]["name"], str(item_id), year, day
-            )
-            if self.execute_statement(statement):
-                if len(self.cursor.fetchall()) < 1:
-                    statement = "INSERT INTO {} (item_id, year, day_in_year, {}{}) VALUES ({}, {}, {}, {})".format(
-                        _tables[_listings]["name"], _sales_hour, hour,
-                        str(item_id), year, day, str(sales)
-                    )
-                    self.execute_statement(statement)
-                else:
-                    statement = "UPDATE {} SET {}{} = {} WHERE item_id={} AND year={} AND day_in_year={}".format(
-                        _listings, _sales_hour, hour, str(sales),
-                        str(item_id), year, day
-                    )
-                    self.execute_statement(statement)
+            self.execute_statement(_statements["upsert_listing_price"],
+                                   (int(item_id), int(realm_id), gu.get_hour_timestamp(), sales))
+
+    def migrate_legacy_tables(self, realm_id: int = 0, drop_legacy: bool = False) -> int:
+        # copies weekly_listings_<week> and item_price_stats rows into listings, returns the number of rows copied
+        # weekly tables only hold the price, item_price_stats rows hold the full aggregate and win where both exist
+        if not self.check_connection("migrate legacy tables"):
+            return 0
+        self.execute_statement(_statements["table_names_like"], (_legacy_listings_prefix + "%",))
+        legacy_tables = [row[0] for row in self.cursor.fetchall()]
+        self.execute_statement(_statements["table_names_like"], (_legacy_price_stats,))
+        has_price_stats = len(self.cursor.fetchall()) > 0
+        batches = []
+        for table_name in legacy_tables:
+            rows = []
+            for item_id, year, day, *hours in self.conn.execute(
+                    "SELECT item_id, year, day_in_year, {} FROM {}".format(
+                        ", ".join("{}{}".format(_legacy_sales_hour, hour) for hour in range(24)), table_name)):
+                for hour, price in enumerate(hours):
+                    if price is not None and price != -1:
+                        rows.append((item_id, realm_id, gu.get_hour_timestamp_for(year, day, hour), price))
+            batches.append(("INSERT OR IGNORE INTO {} (item_id, realm_id, snapshot_ts, min_price) "
+                            "VALUES (?, ?, ?, ?)".format(_listings), rows))
+        if has_price_stats:
+            rows = []
+            for item_id, year, day, hour, *stats in self.conn.execute(
+                    "SELECT item_id, year, day_in_year, hour, {} FROM {}".format(
+                        ", ".join(_stat_columns), _legacy_price_stats)):
+                rows.append((item_id, realm_id, gu.get_hour_timestamp_for(year, day, hour)) + tuple(stats))
+            batches.append(("INSERT OR REPLACE INTO {} (item_id, realm_id, snapshot_ts, {}) "
+                            "VALUES (?, ?, ?, {})".format(_listings, ", ".join(_stat_columns),
+                                                         ", ".join("?" for _ in _stat_columns)), rows))
+            legacy_tables.append(_legacy_price_stats)
+        row_count = sum(len(rows) for statement, rows in batches)
+        # the migrated hours become snapshots, so the export and the anomaly rebuild find them
+        batches.append(("INSERT OR IGNORE INTO {} (realm_id, snapshot_ts, item_count, ingested_at) "
+                        "SELECT realm_id, snapshot_ts, COUNT(*), ? FROM {} WHERE realm_id = ? "
+                        "GROUP BY snapshot_ts".format(_snapshots, _listings), [(int(time.time()), realm_id)]))
+        if drop_legacy:
+            for table_name in legacy_tables:
+                batches.append(("DROP TABLE {}".format(table_name), [()]))
+        if not self.execute_many(batches):
+            return 0
+        self.log.info("Migrated {} rows from {} legacy tables".format(row_count, len(legacy_tables)))
+        first_ts, last_ts = self.conn.execute("SELECT MIN(snapshot_ts), MAX(snapshot_ts) FROM {} "
+                                              "WHERE realm_id = ?".format(_listings), (realm_id,)).fetchone()
+        if first_ts is not None:
+            self.rebuild_rollups(realm_id, first_ts, last_ts + 1)
+        return row_count
 
     def start_connection(self):
+        # reuses an open connection, so long-running processes can keep it warm between runs
+        if self.conn is not None:
+            return
         self.connect_to_db()
-        self.create_tables()
+        if not self.tables_created and not self.read_only:
+            self.create_tables()
+            self.tables_created = self.conn is not None
 
     def find_items_missing_data(self, limit=5):
-        statement = "SELECT * FROM {} WHERE item_name={} OR item_quality={} LIMIT {}".format(
-            _item_names, "'UNDEFINED'", "'UNDEFINED'", limit
-        )
-        self.execute_statement(statement, log_statement=True)
+        self.execute_statement(_statements["items_missing_data"], ("UNDEFINED", "UNDEFINED", int(limit)),
+                               log_statement=True)
         return self.cursor.fetchall()
 
     def update_item_data(self, item_id: int, item_name: str, item_quality: str):
-        statement = "UPDATE {} SET item_name = '{}', item_quality = '{}' WHERE item_id = {}".format(
-            _item_names, item_name, item_quality, str(item_id)
-        )
-        self.execute_statement(statement)
+        # names like "Ogre's Cleaver" are bound as values, so quotes in them need no escaping
+        self.execute_statement(_statements["update_item"], (item_name, item_quality, int(item_id)))
+
+    def update_items_data(self, item_rows: list):
+        # item_rows is a list of (item_name, item_quality, item_id) tuples, written in one transaction
+        if self.check_connection("update " + _item_names) and len(item_rows) > 0:
+            self.execute_many([(_statements["update_item"], item_rows)])
+
+
+def create_table_statement(table: str, schema: str = None) -> str:
+    # CREATE TABLE statement for one of _tables, optionally in an attached database
+    name = _tables[table]["name"] if schema is None else "{}.{}".format(schema, _tables[table]["name"])
+    statement = "CREATE TABLE IF NOT EXISTS {} (".format(name)
+    statement += ", ".join(_tables[table]["columns"] + _tables[table]["constraints"])
+    statement += ")"
+    if "options" in _tables[table]:
+        statement += " " + _tables[table]["options"]
+    return statement
+
+
+def merge_rollup_groups(groups: list) -> dict:
+    # (item_id, min, max, sum, count, volume) groups of one period, read from several files, combined per item
+    merged = {}
+    for item_id, *values in groups:
+        if item_id in merged:
+            values = [combine(a, b, function) for a, b, function in
+                      zip(merged[item_id], values, [min, max, sum_of, sum_of, sum_of])]
+        merged[item_id] = tuple(values)
+    return merged
+
+
+def combine(a, b, function):
+    # NULL aggregates (no price in that file) leave the other side unchanged
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return function(a, b)
+
+
+def sum_of(a, b):
+    return a + b
+
+
+def rollup_upsert_statement(rollup: str) -> str:
+    # rows are (item_id, realm_id, period_ts, min_price, max_price, price_sum, volume) for a single snapshot
+    return "INSERT INTO {0} (item_id, realm_id, period_ts, {1}) VALUES (?, ?, ?, ?, ?, ?, 1, ?) " \
+           "ON CONFLICT(item_id, realm_id, period_ts) DO UPDATE SET " \
+           "min_price = MIN({0}.min_price, excluded.min_price), max_price = MAX({0}.max_price, excluded.max_price), " \
+           "price_sum = {0}.price_sum + excluded.price_sum, samples = {0}.samples + 1, " \
+           "volume = {0}.volume + excluded.volume".format(rollup, ", ".join(_rollup_columns))
 
 
 #######################################################################################################################
@@ -205,6 +724,7 @@ def load_sample_file():
     # There should be sample data in the auction_sample_data directory
     # There is a file on the repository, and the sample main in api_gateway writes data there as well
     # If for some reason there's nothing there, we do create a small fake dataset
+    # Sample files hold one cleaned auction per item, so they are run through the aggregation step as well
     # FWIW, I have been using DB Browser (SQLite) to view data during testing,
     # and I have found it more than adequate if you wanted a suggestion!
     sample_data_folder = os.path.join(os.path.dirname(__file__), "data", "auction_sample_data")
@@ -215,10 +735,10 @@ def load_sample_file():
         filename = os.path.join(sample_data_folder, files[0])
         filename = os.path.normpath(filename)
         with open(filename, 'r') as rf:
-            sales_data = json.load(rf)
+            sample_data = json.load(rf)
             rf.close()
     else:  # if there is no sample data, create some fake data :)
-        sales_data = {
+        sample_data = {
             "32": {
                 "buyout": 1337,
                 "unit_price": "NONE"
@@ -228,7 +748,11 @@ def load_sample_file():
                 "unit_price": 10534
             }
         }
-    return sales_data
+    accumulator = AuctionAccumulator()
+    for item_id, auction in sample_data.items():
+        accumulator.add(item_id, buyout=auction.get("buyout"), unit_price=auction.get("unit_price"),
+                        quantity=auction.get("quantity", 1))
+    return accumulator.summarize()
 
 
 if __name__ == '__main__':
@@ -1,14 +1,34 @@
 #######################################################################################################################
 #
-#   Utility functions used by other modules in this package.  Predominantly datetime methods and logging.
+#   Utility functions used by other modules in this package.  Predominantly datetime methods, logging and
+#   small JSON cache files kept in data/cache.
+#
+#   Logging is configured once per process, however many times initialize_logger is called: the root logger
+#   gets a QueueHandler, and a QueueListener thread writes the records to data/logs/log_<year>_<day>.log,
+#   moving on to the next day's file at midnight.  Logging threads only put records on the queue, never wait
+#   on the file.  The level (default INFO) is set with set_log_level or "log_level" in the config file;
+#   per-item and per-statement lines are logged at DEBUG, so they are dropped before being formatted unless
+#   the level is DEBUG.
 #
 #######################################################################################################################
 
+import atexit
 import datetime
+import json
 import logging
+import logging.handlers
 import os.path
+import queue
+import threading
+import time
 
 _log_folder: str = os.path.join(os.path.dirname(__file__), "data", "logs")
+_log_format: str = "%(asctime)s %(levelname)s %(threadName)s: %(message)s"
+_default_log_level: str = "INFO"
+_log_listener = None  # QueueListener writing to the log file, started by the first initialize_logger call
+_log_lock = threading.Lock()
+_cache_folder: str = os.path.join(os.path.dirname(__file__), "data", "cache")
+_cache_lock = threading.Lock()
 
 
 def get_week() -> str:
@@ -50,19 +70,137 @@ def get_hour() -> str:
     return str(cur_hour)
 
 
-def initialize_logger(process_name: str = "unspecified") -> logging:
-    day = get_year_day()
-    today_log = "log_" + day + ".log"
-    filepath = os.path.join(_log_folder)
-    if not os.path.exists(filepath):
-        os.makedirs(filepath)
-    filename = os.path.join(filepath, today_log)
+def get_hour_timestamp() -> int:
+    # unix timestamp of the start of the current hour
+    cur_hour = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+    return int(cur_hour.timestamp())
+
+
+def get_period_start(timestamp: int, period: str) -> int:
+    # unix timestamp of the local midnight starting the "daily", (Monday-based) "weekly" or "monthly" period
+    start = datetime.datetime.fromtimestamp(timestamp).replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == "weekly":
+        start -= datetime.timedelta(days=start.weekday())
+    elif period == "monthly":
+        start = start.replace(day=1)
+    return int(start.timestamp())
+
+
+def get_period_end(period_start: int, period: str) -> int:
+    start = datetime.datetime.fromtimestamp(period_start)
+    if period == "monthly":
+        end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    else:
+        end = start + datetime.timedelta(days=7 if period == "weekly" else 1)
+    return int(end.timestamp())
+
+
+def get_hour_timestamp_for(year, day_in_year, hour) -> int:
+    # unix timestamp of the start of the given local hour, from the year/day/hour values used by older tables
+    start_of_year = datetime.datetime(int(year), 1, 1)
+    this_hour = start_of_year + datetime.timedelta(days=int(day_in_year) - 1, hours=int(hour))
+    return int(this_hour.timestamp())
+
+
+def initialize_logger(process_name: str = "unspecified", level=None) -> logging:
+    global _log_listener
     logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    new_handler = logging.FileHandler(filename, mode='a', encoding='utf-8')
-    logger.addHandler(new_handler)
+    with _log_lock:
+        if _log_listener is None:
+            if not os.path.exists(_log_folder):
+                os.makedirs(_log_folder)
+            file_handler = DailyFileHandler(_log_folder)
+            file_handler.setFormatter(logging.Formatter(_log_format))
+            log_queue = queue.Queue(-1)
+            _log_listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+            _log_listener.start()
+            logger.addHandler(logging.handlers.QueueHandler(log_queue))
+            logger.setLevel(_default_log_level)
+            atexit.register(stop_logging)
+    if level is not None:
+        set_log_level(level)
     logger.info('**************************************************')
-    time = get_timestamp(human_readable=True)
-    logger.info("Process ({}) started at: {}".format(process_name, time))
+    started = get_timestamp(human_readable=True)
+    logger.info("Process ({}) started at: {}".format(process_name, started))
     logger.info('**************************************************')
     return logger
+
+
+def set_log_level(level):
+    # level is a name ("DEBUG", "INFO", ...) or a logging constant
+    logging.getLogger().setLevel(level.upper() if isinstance(level, str) else level)
+
+
+def stop_logging():
+    # flushes the queue to the file, called at exit
+    global _log_listener
+    with _log_lock:
+        if _log_listener is None:
+            return
+        _log_listener.stop()
+        logger = logging.getLogger()
+        for handler in list(logger.handlers):
+            if isinstance(handler, logging.handlers.QueueHandler) and handler.queue is _log_listener.queue:
+                logger.removeHandler(handler)
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+
+
+def daily_log_file(folder: str) -> str:
+    return os.path.join(folder, "log_" + get_year_day() + ".log")
+
+
+class DailyFileHandler(logging.handlers.TimedRotatingFileHandler):
+    # rolls over at midnight by opening the new day's log_<year>_<day>.log, instead of renaming the old file
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        super().__init__(daily_log_file(folder), when="midnight", encoding="utf-8", delay=True)
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        self.baseFilename = daily_log_file(self.folder)
+        self.rolloverAt = self.computeRollover(int(time.time()))
+
+
+def set_cache_folder(folder: str):
+    # points the cache files somewhere else, e.g. a temporary folder for runs against the mock server
+    global _cache_folder
+    _cache_folder = folder
+
+
+def get_cache_file(name: str) -> str:
+    if not os.path.exists(_cache_folder):
+        os.makedirs(_cache_folder)
+    return os.path.join(_cache_folder, name)
+
+
+def load_json_file(filename: str, default=None):
+    try:
+        with open(filename, 'r') as rf:
+            return json.load(rf)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json_file(filename: str, data, private: bool = False):
+    # write to a temporary file first so a crash never leaves a half-written cache behind
+    # private files (access tokens) are created readable by the owner only
+    temp_filename = filename + ".tmp"
+    if os.path.exists(temp_filename):
+        os.remove(temp_filename)  # a leftover temporary file would keep its old permissions
+    handle = os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600 if private else 0o666)
+    with os.fdopen(handle, 'w') as wf:
+        json.dump(data, wf, indent=2, sort_keys=True)
+    os.replace(temp_filename, filename)
+
+
+def update_json_file(filename: str, key: str, value, private: bool = False):
+    # read-modify-write of one key, safe against other threads updating the same cache file
+    with _cache_lock:
+        data = load_json_file(filename, default={})
+        data[key] = value
+        save_json_file(filename, data, private=private)
@@ -0,0 +1,82 @@
+#######################################################################################################################
+#
+#   Incremental JSON parsing for large API payloads.  Rather than loading a whole response body and building
+#   the full object tree, iter_array_items reads the body chunk by chunk and yields the entries of one
+#   top-level array (e.g. "auctions") as they become complete.  Only the entry being decoded and the unread
+#   part of the current chunk are held in memory.
+#
+#   Chunks may be bytes (decoded as UTF-8, split multi-byte characters are handled) or str.  Array entries are
+#   expected to be objects, as they are for every Battle.net listing payload.
+#
+#######################################################################################################################
+
+import codecs
+import json
+import re
+
+# global variables:
+_key_separator = re.compile(r"[ \t\n\r:]*")
+_item_separator = re.compile(r"[ \t\n\r,]*")
+
+
+def iter_array_items(chunks, key: str):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer = ""
+    position = 0
+    in_array = False
+    marker = '"{}"'.format(key)
+
+    def read_more() -> bool:
+        nonlocal buffer, position
+        for chunk in chunks:
+            if isinstance(chunk, bytes):
+                chunk = text_decoder.decode(chunk)
+            if chunk:
+                buffer = buffer[position:] + chunk
+                position = 0
+                return True
+        return False
+
+    # find the start of the array, keeping enough of the buffer to match a marker split across chunks
+    while not in_array:
+        found = buffer.find(marker, position)
+        if found < 0:
+            position = max(position, len(buffer) - len(marker))
+            if not read_more():
+                return
+            continue
+        cursor = found + len(marker)
+        while True:
+            cursor = _key_separator.match(buffer, cursor).end()
+            if cursor < len(buffer):
+                break
+            position = found
+            if not read_more():
+                return
+            found = 0
+            cursor = len(marker)
+        if buffer[cursor] == "[":
+            position = cursor + 1
+            in_array = True
+        else:
+            position = found + len(marker)  # the key appeared somewhere other than in front of an array
+
+    while True:
+        position = _item_separator.match(buffer, position).end()
+        if position >= len(buffer):
+            if not read_more():
+                return
+            continue
+        if buffer[position] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # the entry is cut off at the end of the buffer, pull in the next chunk and try again
+            if not read_more():
+                raise
+            continue
+        position = end
+        yield item
@@ -0,0 +1,177 @@
+#######################################################################################################################
+#
+#   Lightweight instrumentation for collection runs.  A RunMetrics object is shared by the controller and its
+#   gateways for one run and collects:
+#       stage timers:   seconds spent in token fetch, request, download, parse, clean, db_write, archive and
+#                       backfill.  Stage times are exclusive: time spent in a stage nested inside another (the
+#                       download of each chunk while a payload is parsed) only counts towards the inner one.
+#                       Stages on worker threads are added up, so they can exceed the run's wall time.
+#       counters:       requests, bytes downloaded, auctions parsed, items and rows written, new items, items
+#                       backfilled and targets per outcome.
+#       gauges:         last value seen, e.g. known_items, the size of the item table as it grows.
+#
+#   finish() returns one flat record per run, appended to data/metrics/runs.jsonl and (with "csv": true)
+#   data/metrics/runs.csv, whose columns are fixed so the file can be trended and alerted on.
+#
+#   Optional hooks, off by default, set in the "metrics" section of the config file:
+#       "cprofile": true    profiles the main thread (the writer) and writes data/metrics/<run_id>.prof
+#       "tracemalloc": true records the peak traced memory of the run in MB (slows the run down)
+#
+#######################################################################################################################
+
+import cProfile
+import csv
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# global variables:
+_metrics_folder: str = os.path.join(os.path.dirname(__file__), "data", "metrics")
+_runs_json: str = "runs.jsonl"
+_runs_csv: str = "runs.csv"
+_stages: [str] = ["token", "request", "download", "parse", "clean", "db_write", "archive", "backfill"]
+_counters: [str] = ["requests", "bytes", "auctions", "items", "rows", "new_items", "items_backfilled",
+                    "targets_ok", "targets_not_modified", "targets_failed"]
+_gauges: [str] = ["known_items"]
+_default_metrics_config: dict = \
+    {
+        "enabled": True,
+        "csv": True,
+        "cprofile": False,
+        "tracemalloc": False
+    }
+
+
+class RunMetrics(object):
+
+    def __init__(self, logger=None, metrics_config: dict = None, metrics_folder: str = _metrics_folder):
+        self.log = logger
+        self.config = dict(_default_metrics_config)
+        self.config.update(metrics_config or {})
+        self.metrics_folder = metrics_folder
+        self.run_id = None
+        self.started_at = None
+        self.start_time = None
+        self.stage_seconds = {}
+        self.stage_calls = {}
+        self.counters = {}
+        self.gauges = {}
+        self.profiler = None
+        self.lock = threading.Lock()
+        self.local = threading.local()  # per-thread stack of open stages
+
+    def start(self):
+        self.run_id = time.strftime("%Y%m%dT%H%M%S")
+        self.started_at = int(time.time())
+        self.start_time = time.perf_counter()
+        if self.config["tracemalloc"]:
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+        if self.config["cprofile"]:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    @contextmanager
+    def stage(self, name: str):
+        stack = self.stage_stack()
+        stack.append(0.0)  # seconds spent in stages nested inside this one
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if len(stack) > 0:
+                stack[-1] += elapsed
+            self.add_time(name, elapsed - nested)
+
+    def stage_stack(self) -> list:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def add_time(self, name: str, seconds: float, calls: int = 1):
+        with self.lock:
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + seconds
+            self.stage_calls[name] = self.stage_calls.get(name, 0) + calls
+
+    def count(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name: str, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def timed_chunks(self, chunks, stage: str = "download"):
+        # wraps a chunk iterator, timing every read as the given stage and counting its bytes
+        iterator = iter(chunks)
+        while True:
+            with self.stage(stage):
+                chunk = next(iterator, None)
+            if chunk is None:
+                return
+            self.count("bytes", len(chunk))
+            yield chunk
+
+    def finish(self) -> dict:
+        if self.start_time is None:
+            return {}
+        record = {"run_id": self.run_id, "started_at": self.started_at,
+                  "run_seconds": round(time.perf_counter() - self.start_time, 3)}
+        if self.profiler is not None:
+            self.profiler.disable()
+            record["profile_file"] = self.dump_profile()
+            self.profiler = None
+        if self.config["tracemalloc"] and tracemalloc.is_tracing():
+            record["peak_memory_mb"] = round(tracemalloc.get_traced_memory()[1] / 1e6, 1)
+            tracemalloc.stop()
+        with self.lock:
+            for name in sorted(set(_stages) | set(self.stage_seconds)):
+                record[name + "_seconds"] = round(self.stage_seconds.get(name, 0.0), 3)
+                record[name + "_calls"] = self.stage_calls.get(name, 0)
+            for name in sorted(set(_counters) | set(self.counters)):
+                record[name] = self.counters.get(name, 0)
+            for name in sorted(set(_gauges) | set(self.gauges)):
+                record[name] = self.gauges.get(name)
+        self.start_time = None
+        if self.config["enabled"]:
+            self.write(record)
+        if self.log is not None:
+            self.log.info("Run {} took {}s: ".format(self.run_id, record["run_seconds"]) + ", ".join(
+                "{} {}s".format(name, record[name + "_seconds"]) for name in _stages))
+        return record
+
+    def dump_profile(self) -> str:
+        filename = os.path.join(self.metrics_folder, "{}.prof".format(self.run_id))
+        self.make_folder()
+        self.profiler.dump_stats(filename)
+        return filename
+
+    def write(self, record: dict):
+        self.make_folder()
+        with open(os.path.join(self.metrics_folder, _runs_json), 'a') as wf:
+            wf.write(json.dumps(record) + "\n")
+        if self.config["csv"]:
+            csv_file = os.path.join(self.metrics_folder, _runs_csv)
+            new_file = not os.path.exists(csv_file)
+            with open(csv_file, 'a', newline='') as wf:
+                writer = csv.DictWriter(wf, fieldnames=csv_columns(), extrasaction="ignore")
+                if new_file:
+                    writer.writeheader()
+                writer.writerow(record)
+
+    def make_folder(self):
+        if not os.path.exists(self.metrics_folder):
+            os.makedirs(self.metrics_folder)
+
+
+def csv_columns() -> [str]:
+    # fixed, so runs that skip a stage (or add a new one) still line up under the same header
+    columns = ["run_id", "started_at", "run_seconds", "peak_memory_mb"]
+    for name in _stages:
+        columns += [name + "_seconds", name + "_calls"]
+    return columns + _counters + _gauges
@@ -0,0 +1,263 @@
+#######################################################################################################################
+#
+#   A local stand-in for the Battle.net API, so the whole collection path (Controller.main) can run offline and
+#   under load.  Serves, for any region:
+#       POST /<region>/oauth/token                                  an access token
+#       GET  /<region>/data/wow/connected-realm/<id>/auctions       a synthetic auction snapshot
+#       GET  /<region>/data/wow/auctions/commodities                a synthetic commodity snapshot
+#       GET  /<region>/data/wow/item/<id>                           an item name and quality
+#   Point a config at it with the "base_urls" section (see api_gateway.py); base_urls() returns the values.
+#
+#   Snapshots are built by synthetic_data.py, scaled off example_auction_data.json ("scale" and
+#   "commodity_scale" set their size, so large payloads are one setting away), and encoded once per realm.
+#   Every auction request reports a new snapshot (fresh ETag and Last-Modified) unless "snapshot_seconds" is
+#   set, in which case the snapshot changes that often and conditional requests within it get a 304.  Realm
+#   ids not in "realms" get a 404, like retired connected realms.
+#
+#   Injected faults, all off by default:
+#       latency_ms / latency_jitter     delay before every response, +/- jitter as a fraction of latency_ms
+#       throttle_rate                   share of requests answered 429 with a Retry-After header
+#       item_404_rate                   share of item lookups answered 404
+#   Every response is timed, from the request line to the last byte written, per endpoint; stats() returns
+#   the counts, status codes and latency percentiles, which benchmark.py end-to-end reports.
+#
+#   Run standalone with:
+#       python mock_server.py [--port 8765] [--realms 74 96] [--scale 10] [--latency-ms 20] [--throttle-rate 0.01]
+#
+#######################################################################################################################
+
+import argparse
+import email.utils
+import json
+import logging
+import random
+import threading
+import time
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import synthetic_data
+
+# global variables:
+_default_mock_config: dict = \
+    {
+        "realms": [74, 96, 156, 1068, 1259, 1267, 1276, 1280, 1567],
+        "scale": 1.0,  # auctions per realm snapshot, in multiples of the sample
+        "commodity_scale": 1.0,
+        "snapshot_seconds": 0,  # 0: every auction request is a new snapshot
+        "token_seconds": 86399,
+        "latency_ms": 0,
+        "latency_jitter": 0.5,
+        "throttle_rate": 0.0,
+        "retry_after": 1,  # seconds, sent with every 429
+        "item_404_rate": 0.0,
+        "seed": 1
+    }
+_qualities: [str] = ["POOR", "COMMON", "UNCOMMON", "RARE", "EPIC", "LEGENDARY"]
+_token_prefix: str = "mock-"
+_json_type: str = "application/json;charset=UTF-8"
+
+
+class MockBattleNet(object):
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, mock_config: dict = None, logger=None):
+        # port=0 picks a free port, see url()
+        self.config = dict(_default_mock_config)
+        self.config.update(mock_config or {})
+        self.log = logger if logger is not None else logging.getLogger("mock_server")
+        self.rng = random.Random(self.config["seed"])
+        self.lock = threading.Lock()
+        self.payloads = {}  # realm id, or "commodities" -> encoded snapshot
+        self.snapshot_counter = 0
+        self.token_counter = 0
+        self.latencies = {}  # endpoint -> [seconds, ...]
+        self.statuses = {}  # endpoint -> {status code: count}
+        self.server = ThreadingHTTPServer((host, port), MockRequestHandler)
+        self.server.daemon_threads = True
+        self.server.mock = self
+        self.thread = None
+
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def base_urls(self) -> dict:
+        return {"token": self.url() + "/{region}/oauth/token", "api": self.url() + "/{region}/data/wow/"}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mock_server", daemon=True)
+        self.thread.start()
+        self.log.info("Mock Battle.net API listening on " + self.url())
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def respond(self, handler: BaseHTTPRequestHandler, method: str):
+        start = time.perf_counter()
+        endpoint, status, headers, body = self.route(handler, method)
+        if self.config["latency_ms"] > 0:
+            jitter = self.config["latency_jitter"]
+            time.sleep(self.config["latency_ms"] / 1000 * self.rng.uniform(1 - jitter, 1 + jitter))
+        handler.send_response(status)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        if method != "HEAD":
+            handler.wfile.write(body)
+        self.record(endpoint, status, time.perf_counter() - start)
+
+    def route(self, handler: BaseHTTPRequestHandler, method: str) -> (str, int, dict, bytes):
+        # returns (endpoint, status, headers, body)
+        parts = handler.path.split("?")[0].strip("/").split("/")
+        if method == "POST" and parts[1:] == ["oauth", "token"]:
+            return self.token_response()
+        if parts[1:3] != ["data", "wow"] or method != "GET":
+            return "unknown", 404, {}, b""
+        resource = parts[3:]
+        if len(resource) == 3 and resource[0] == "connected-realm" and resource[2] == "auctions":
+            endpoint = "auctions"
+        elif resource == ["auctions", "commodities"]:
+            endpoint = "commodities"
+        elif len(resource) == 2 and resource[0] == "item":
+            endpoint = "item"
+        else:
+            return "unknown", 404, {}, b""
+        if not handler.headers.get("Authorization", "").startswith("Bearer " + _token_prefix):
+            return endpoint, 401, {}, b""
+        if self.rng.random() < self.config["throttle_rate"]:
+            return endpoint, 429, {"Retry-After": str(self.config["retry_after"])}, b""
+        if endpoint == "item":
+            return self.item_response(resource[1])
+        key = "commodities" if endpoint == "commodities" else resource[1]
+        if endpoint == "auctions" and not (key.isdigit() and int(key) in self.config["realms"]):
+            return endpoint, 404, {}, b""
+        return self.snapshot_response(endpoint, key, handler.headers.get("If-None-Match"))
+
+    def token_response(self) -> (str, int, dict, bytes):
+        with self.lock:
+            self.token_counter += 1
+            token = _token_prefix + str(self.token_counter)
+        body = json.dumps({"access_token": token, "token_type": "bearer",
+                           "expires_in": self.config["token_seconds"]}).encode("utf-8")
+        return "token", 200, {"Content-Type": _json_type}, body
+
+    def item_response(self, item_id: str) -> (str, int, dict, bytes):
+        if not item_id.isdigit() or self.rng.random() < self.config["item_404_rate"]:
+            return "item", 404, {}, b""
+        body = json.dumps({"id": int(item_id), "name": "Mock Item {}".format(item_id),
+                           "quality": {"type": _qualities[int(item_id) % len(_qualities)]}}).encode("utf-8")
+        return "item", 200, {"Content-Type": _json_type}, body
+
+    def snapshot_response(self, endpoint: str, key: str, if_none_match) -> (str, int, dict, bytes):
+        if self.config["snapshot_seconds"] > 0:
+            version = int(time.time() // self.config["snapshot_seconds"])
+            modified = version * self.config["snapshot_seconds"]
+        else:
+            with self.lock:
+                self.snapshot_counter += 1
+                version = self.snapshot_counter
+            modified = time.time()
+        etag = '"{}-{}"'.format(key, version)
+        headers = {"ETag": etag, "Last-Modified": email.utils.formatdate(modified, usegmt=True)}
+        if if_none_match == etag:
+            return endpoint, 304, headers, b""
+        headers["Content-Type"] = _json_type
+        return endpoint, 200, headers, self.payload(key)
+
+    def payload(self, key: str) -> bytes:
+        # built on first use and kept, the realm id seeds its prices
+        with self.lock:
+            if key not in self.payloads:
+                start = time.perf_counter()
+                if key == "commodities":
+                    payload = synthetic_data.build_auction_payload(self.config["commodity_scale"], seed=0)
+                else:
+                    payload = synthetic_data.build_auction_payload(self.config["scale"], seed=int(key))
+                self.payloads[key] = json.dumps(payload).encode("utf-8")
+                self.log.info("Built {} snapshot: {} auctions, {:.1f} MB in {:.2f}s".format(
+                    key, len(payload["auctions"]), len(self.payloads[key]) / 1e6, time.perf_counter() - start))
+            return self.payloads[key]
+
+    def record(self, endpoint: str, status: int, seconds: float):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            codes = self.statuses.setdefault(endpoint, {})
+            codes[status] = codes.get(status, 0) + 1
+
+    def stats(self) -> dict:
+        # {endpoint: {"requests", "statuses", "p50_ms", "p95_ms", "p99_ms", "max_ms"}}
+        with self.lock:
+            latencies = {endpoint: np.array(values) * 1000 for endpoint, values in self.latencies.items()}
+            statuses = {endpoint: dict(codes) for endpoint, codes in self.statuses.items()}
+        stats = {}
+        for endpoint in sorted(latencies):
+            values = latencies[endpoint]
+            stats[endpoint] = {
+                "requests": len(values),
+                "statuses": statuses[endpoint],
+                "p50_ms": round(float(np.percentile(values, 50)), 1),
+                "p95_ms": round(float(np.percentile(values, 95)), 1),
+                "p99_ms": round(float(np.percentile(values, 99)), 1),
+                "max_ms": round(float(values.max()), 1)
+            }
+        return stats
+
+    def reset_stats(self):
+        with self.lock:
+            self.latencies = {}
+            self.statuses = {}
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so the gateway's pooled connections are reused as with Blizzard
+
+    def do_GET(self):
+        self.server.mock.respond(self, "GET")
+
+    def do_POST(self):
+        # the token request carries the client credentials as a form body, read so the connection stays usable
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.mock.respond(self, "POST")
+
+    def log_message(self, format, *args):
+        pass  # a line per request would swamp the output, stats() has the numbers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the Battle.net API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--realms", type=int, nargs="+", default=_default_mock_config["realms"])
+    parser.add_argument("--scale", type=float, default=1.0, help="auctions per realm snapshot, x the sample")
+    parser.add_argument("--commodity-scale", type=float, default=1.0)
+    parser.add_argument("--snapshot-seconds", type=int, default=0, help="0 makes every request a new snapshot")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of requests answered 429")
+    parser.add_argument("--item-404-rate", type=float, default=0.0, help="share of item lookups answered 404")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    mock = MockBattleNet(args.host, args.port, {
+        "realms": args.realms,
+        "scale": args.scale,
+        "commodity_scale": args.commodity_scale,
+        "snapshot_seconds": args.snapshot_seconds,
+        "latency_ms": args.latency_ms,
+        "throttle_rate": args.throttle_rate,
+        "item_404_rate": args.item_404_rate
+    })
+    print("Add to the config file:\n" + json.dumps({"base_urls": mock.base_urls()}, indent=2))
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock.server.server_close()
+        print(json.dumps(mock.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
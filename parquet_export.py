@@ -0,0 +1,148 @@
+#######################################################################################################################
+#
+#   Export of the price history to Parquet files for offline analysis (pandas, polars, DuckDB, Spark).
+#
+#   Listings are written to data/export/listings/week=<monday>/realm_id=<id>/part-<first_ts>-<last_ts>.parquet,
+#   a Hive-style layout that pyarrow.dataset and pandas.read_parquet read back as one partitioned table.  Each
+#   row is one item in one hourly snapshot (item_id, snapshot_ts and the listings statistics), so the hourly
+#   data of legacy weekly tables arrives already unpivoted once migrated.  Item names and qualities are
+#   rewritten to data/export/items.parquet on every export.
+#
+#   Exports are incremental: the last exported snapshot per realm is kept in data/export/export_state.json and
+#   only newer snapshots are read, each (week, realm) through the listings (realm_id, snapshot_ts) index of the
+#   main database and of any monthly shard holding part of the week (see shards.py; archived shards are read
+#   from a temporary unpacked copy), in chunks that go straight from SQLite rows to NumPy columns to Arrow
+#   record batches.  full=True clears the
+#   listings export and starts over.  A snapshot re-ingested after it was exported is not exported again.
+#
+#   pyarrow is optional and only imported when an export runs.
+#
+#######################################################################################################################
+
+import os
+import shutil
+import time
+import numpy as np
+import generic_util as gu
+
+# global variables:
+_export_path: str = os.path.join(os.path.dirname(__file__), "data", "export")
+_export_state_file: str = "export_state.json"
+_chunk_rows: int = 100000
+_listing_columns: [str] = ["item_id", "snapshot_ts", "min_price", "median_price", "mean_price", "p10_price",
+                           "p90_price", "quantity", "listings"]
+_item_columns: [str] = ["item_id", "item_name", "item_quality"]
+
+
+class ParquetExporter(object):
+
+    def __init__(self, db_gateway, logger, export_path: str = _export_path, chunk_rows: int = _chunk_rows):
+        self.dg = db_gateway
+        self.log = logger
+        self.export_path = export_path
+        self.chunk_rows = chunk_rows
+        self.state_file = os.path.join(export_path, _export_state_file)
+
+    def export(self, full: bool = False) -> int:
+        # returns the number of listing rows written
+        pa, pq = import_pyarrow()
+        start = time.perf_counter()
+        listings_path = os.path.join(self.export_path, "listings")
+        if not os.path.exists(self.export_path):
+            os.makedirs(self.export_path)  # holds the export state, even before any partition is written
+        if full:
+            if os.path.exists(listings_path):
+                shutil.rmtree(listings_path)
+            if os.path.exists(self.state_file):
+                os.remove(self.state_file)
+        exported = gu.load_json_file(self.state_file, default={})
+        row_count = 0
+        partitions = self.pending_partitions(exported)
+        try:
+            for (realm_id, week_ts), snapshot_times in partitions:
+                first_ts, last_ts = snapshot_times[0], snapshot_times[-1]
+                folder = os.path.join(listings_path, "week={}".format(week_label(week_ts)),
+                                      "realm_id={}".format(realm_id))
+                row_count += self.write_listings(pa, pq, folder, realm_id, first_ts, last_ts)
+                # saved per partition, so an interrupted export resumes where it stopped
+                gu.update_json_file(self.state_file, str(realm_id), last_ts)
+        finally:
+            self.dg.shards.release_unpacked()
+        self.write_items(pa, pq)
+        self.log.info("Exported {} listing rows in {} partitions to {} in {:.2f}s".format(
+            row_count, len(partitions), self.export_path, time.perf_counter() - start))
+        return row_count
+
+    def pending_partitions(self, exported: dict) -> list:
+        # [((realm_id, week_ts), [snapshot_ts, ...]), ...] for every snapshot not exported yet
+        partitions = {}
+        for realm_id, snapshot_ts in self.dg.conn.execute(
+                "SELECT realm_id, snapshot_ts FROM snapshots ORDER BY realm_id, snapshot_ts"):
+            if snapshot_ts <= exported.get(str(realm_id), -1):
+                continue
+            key = (realm_id, gu.get_period_start(snapshot_ts, "weekly"))
+            partitions.setdefault(key, []).append(snapshot_ts)
+        return sorted(partitions.items())
+
+    def write_listings(self, pa, pq, folder: str, realm_id: int, first_ts: int, last_ts: int) -> int:
+        statement = "SELECT {} FROM {{}}.listings WHERE realm_id = ? AND snapshot_ts >= ? AND snapshot_ts <= ? " \
+                    "ORDER BY snapshot_ts, item_id".format(", ".join(_listing_columns))
+        filename = os.path.join(folder, "part-{}-{}.parquet".format(first_ts, last_ts))
+        writer = None
+        row_count = 0
+        try:
+            for rows in self.dg.shards.listing_chunks(statement, (realm_id, first_ts, last_ts), first_ts, last_ts + 1,
+                                                      chunk_rows=self.chunk_rows, include_archived=True):
+                batch = listing_batch(pa, rows)
+                if writer is None:
+                    if not os.path.exists(folder):
+                        os.makedirs(folder)
+                    writer = pq.ParquetWriter(filename + ".tmp", batch.schema, compression="zstd")
+                writer.write_batch(batch)
+                row_count += len(rows)
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is not None:
+            os.replace(filename + ".tmp", filename)
+        return row_count
+
+    def write_items(self, pa, pq):
+        rows = self.dg.conn.execute("SELECT {} FROM item_names ORDER BY item_id".format(
+            ", ".join(_item_columns))).fetchall()
+        columns = list(zip(*rows)) if len(rows) > 0 else [[] for _ in _item_columns]
+        table = pa.table({
+            "item_id": pa.array(columns[0], type=pa.int64()),
+            "item_name": pa.array(columns[1], type=pa.string()),
+            "item_quality": pa.array(columns[2], type=pa.string())
+        })
+        if not os.path.exists(self.export_path):
+            os.makedirs(self.export_path)
+        filename = os.path.join(self.export_path, "items.parquet")
+        pq.write_table(table, filename + ".tmp", compression="zstd")
+        os.replace(filename + ".tmp", filename)
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet export needs pyarrow, install it with: pip install pyarrow")
+    return pyarrow, pyarrow.parquet
+
+
+def listing_batch(pa, rows: list):
+    # NULL statistics (rows migrated from legacy tables only hold a price) become nulls, not zeros
+    table = np.array(rows, dtype=np.float64)
+    arrays = []
+    for i, column in enumerate(_listing_columns):
+        values = table[:, i]
+        missing = np.isnan(values)
+        arrays.append(pa.array(np.where(missing, 0, values).astype(np.int64), type=pa.int64(),
+                               mask=missing if missing.any() else None))
+    return pa.RecordBatch.from_arrays(arrays, names=_listing_columns)
+
+
+def week_label(week_ts: int) -> str:
+    return time.strftime("%Y-%m-%d", time.localtime(week_ts))
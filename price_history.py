@@ -0,0 +1,104 @@
+#######################################################################################################################
+#
+#   Read path for plotting price trends.  Returns an item's price history over a time range as NumPy arrays,
+#   either hourly (straight from listings) or from the daily/weekly rollup tables that DatabaseGateway keeps
+#   up to date at ingest time.  Uses the connection of an open DatabaseGateway.
+#
+#   Hourly series hold every column of listings:
+#       {"timestamp", "min_price", "median_price", "mean_price", "p10_price", "p90_price", "quantity", "listings"}
+#   Daily and weekly series summarize the hourly minimum price over each period:
+#       {"timestamp", "min_price", "avg_price", "max_price", "volume", "samples"}
+#   and hold every period overlapping the range, so a range starting mid-day still includes that day.
+#
+#   Hourly listings older than the hot window live in monthly shards (see shards.py); hourly series are read
+#   from the main database and every active shard overlapping the range, and merged in order.
+#
+#   Timestamps are unix seconds (snapshot hour, or the local midnight starting the period).  realm_id=None
+#   reads every realm, in which case the arrays are ordered by realm and then time.
+#
+#######################################################################################################################
+
+import json
+import numpy as np
+import generic_util as gu
+
+# global variables:
+_resolutions: dict = \
+    {
+        "hourly": "listings",
+        "daily": "rollup_daily",
+        "weekly": "rollup_weekly"
+    }
+_hourly_columns: [str] = ["min_price", "median_price", "mean_price", "p10_price", "p90_price", "quantity", "listings"]
+_rollup_select: str = "period_ts, min_price, CAST(price_sum AS REAL) / samples, max_price, volume, samples"
+_rollup_keys: [str] = ["timestamp", "min_price", "avg_price", "max_price", "volume", "samples"]
+
+
+class PriceHistory(object):
+
+    def __init__(self, db_gateway):
+        self.dg = db_gateway
+
+    def price_series(self, item_id: int, start_ts: int, end_ts: int, realm_id: int = None,
+                     resolution: str = "daily") -> dict:
+        return self.price_series_many([item_id], start_ts, end_ts, realm_id, resolution).get(
+            int(item_id), empty_series(resolution))
+
+    def price_series_many(self, item_ids: list, start_ts: int, end_ts: int, realm_id: int = None,
+                          resolution: str = "daily") -> dict:
+        # one query for all items, split into one dict of arrays per item id
+        statement, keys = build_query(resolution, realm_id is not None)
+        params = [json.dumps([int(item_id) for item_id in item_ids])]
+        if realm_id is not None:
+            params.append(realm_id)
+        if resolution in ("daily", "weekly"):
+            start_ts = gu.get_period_start(start_ts, resolution)  # rollup rows are keyed by the period start
+        params += [start_ts, end_ts]
+        if resolution == "hourly":
+            rows = self.dg.shards.query_listings(statement, params, start_ts, end_ts)
+        else:
+            rows = self.dg.conn.execute(statement, params).fetchall()
+        if len(rows) == 0:
+            return {}
+        table = np.array(rows, dtype=np.float64)
+        table = table[np.lexsort((table[:, 2], table[:, 1], table[:, 0]))]  # one read per file, merged here
+        ids = table[:, 0].astype(np.int64)
+        starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+        ends = np.append(starts[1:], len(ids))
+        series = {}
+        for start, end in zip(starts, ends):
+            block = table[start:end, 2:]
+            series[int(ids[start])] = {key: to_array(key, block[:, i]) for i, key in enumerate(keys)}
+        return series
+
+
+def build_query(resolution: str, by_realm: bool) -> (str, [str]):
+    if resolution not in _resolutions:
+        raise ValueError("Unknown resolution: " + str(resolution))
+    table = _resolutions[resolution]
+    if resolution == "hourly":
+        table = "{}." + table  # formatted with the schema of the main database or a shard
+        time_column = "snapshot_ts"
+        select = "snapshot_ts, " + ", ".join(_hourly_columns)
+        keys = ["timestamp"] + _hourly_columns
+    else:
+        time_column = "period_ts"
+        select = _rollup_select
+        keys = _rollup_keys
+    statement = "SELECT item_id, realm_id, {} FROM {} WHERE item_id IN (SELECT value FROM json_each(?)) ".format(
+        select, table)
+    if by_realm:
+        statement += "AND realm_id = ? "
+    statement += "AND {0} >= ? AND {0} < ? ORDER BY item_id, realm_id, {0}".format(time_column)
+    return statement, keys
+
+
+def to_array(key: str, column):
+    if key == "avg_price":
+        return column
+    return column.astype(np.int64) if not np.isnan(column).any() else column
+
+
+def empty_series(resolution: str) -> dict:
+    keys = ["timestamp"] + _hourly_columns if resolution == "hourly" else _rollup_keys
+    return {key: np.zeros(0, dtype=np.int64) for key in keys}
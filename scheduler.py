@@ -0,0 +1,120 @@
+#######################################################################################################################
+#
+#   Long-running daemon mode (python . --daemon).  Instead of a fresh process every hour, one process keeps the
+#   controller, its HTTP sessions, tokens and database connection warm and collects on an internal schedule.
+#
+#   Collections are aligned to Blizzard's snapshot refresh: when the last snapshot carried a Last-Modified
+#   header, the next one is expected an hour later, and the collection runs a short grace period after that.
+#   If Blizzard is late (the conditional request comes back unchanged), the scheduler polls again every few
+#   minutes until the new snapshot shows up.  Without a Last-Modified header it falls back to a fixed offset
+#   past the top of the hour.  Time between collections is used for item backfill, in batches, stopping
+#   early enough that a batch never runs into the next collection.
+#
+#   Each cycle is measured as one run (see metrics.py): a collection and the backfill that follows it, up to
+#   the start of the next collection.
+#
+#   The clock and sleep functions are injectable, so the loop can be driven by a fake clock in testing.
+#
+#######################################################################################################################
+
+import time
+from email.utils import parsedate_to_datetime
+
+# global variables:
+_default_schedule_config: dict = \
+    {
+        "refresh_interval": 3600,  # seconds between Blizzard snapshots
+        "grace_period": 120,  # seconds to wait after the expected refresh before collecting
+        "retry_interval": 300,  # seconds between polls while the new snapshot is late
+        "backfill_batch": 500,  # items per backfill batch between collections
+        "backfill_margin": 180  # no backfill batch starts this close to the next collection
+    }
+
+
+class Scheduler(object):
+
+    def __init__(self, controller, logger, schedule_config: dict = None, clock=time.time, sleep=time.sleep):
+        self.controller = controller
+        self.log = logger
+        self.config = dict(_default_schedule_config)
+        self.config.update(schedule_config or {})
+        self.clock = clock
+        self.sleep = sleep
+        self.next_collection = None
+        self.backfill_done = False
+
+    def run(self, max_cycles: int = None):
+        # one cycle is one collection plus the idle time after it, max_cycles=None runs until interrupted
+        self.controller.keep_connection = True
+        cycles = 0
+        try:
+            self.next_collection = self.clock()
+            while max_cycles is None or cycles < max_cycles:
+                self.wait_and_backfill(self.next_collection)
+                self.run_collection()
+                cycles += 1
+        except KeyboardInterrupt:
+            self.log.info("Daemon interrupted, shutting down")
+        finally:
+            self.controller.finish_run()
+            self.controller.keep_connection = False
+            self.controller.release_connection()
+        return cycles
+
+    def run_collection(self):
+        started = self.clock()
+        self.controller.start_run()
+        self.log.info("Daemon collection started at {}".format(started))
+        try:
+            results = self.controller.collect_and_store_data()
+        except Exception as e:
+            self.log.error("Daemon collection failed: {}".format(e))
+            results = []
+        fresh = any(result["status"] == "ok" for result in results)
+        if fresh:
+            self.backfill_done = False  # a new snapshot may have brought new unnamed items
+        self.next_collection = self.next_collection_time(self.clock(), fresh)
+        self.log.info("Next collection at {} ({:.0f}s from now)".format(
+            self.next_collection, self.next_collection - self.clock()))
+
+    def next_collection_time(self, now: float, fresh: bool) -> float:
+        last_modified = self.latest_snapshot_time()
+        interval = self.config["refresh_interval"]
+        if last_modified is not None:
+            expected = last_modified + interval + self.config["grace_period"]
+            while expected <= now - interval:
+                expected += interval  # skip refreshes we already missed entirely
+            if expected > now:
+                return expected
+            # the refresh is due but we didn't see it (or it is late), poll again shortly
+            return now + self.config["retry_interval"]
+        if not fresh:
+            return now + self.config["retry_interval"]
+        next_hour = (int(now) // interval + 1) * interval
+        return next_hour + self.config["grace_period"]
+
+    def latest_snapshot_time(self):
+        # the earliest Last-Modified among targets, so no target's refresh is waited past
+        times = []
+        for gateway in self.controller.gateways:
+            if gateway.last_modified is not None:
+                try:
+                    times.append(parsedate_to_datetime(gateway.last_modified).timestamp())
+                except (TypeError, ValueError):
+                    continue
+        return min(times) if len(times) > 0 else None
+
+    def wait_and_backfill(self, until: float):
+        while True:
+            remaining = until - self.clock()
+            if remaining <= 0:
+                return
+            if not self.backfill_done and remaining > self.config["backfill_margin"]:
+                try:
+                    fixed = self.controller.fix_unnamed_items(self.config["backfill_batch"])
+                except Exception as e:
+                    self.log.error("Daemon backfill failed: {}".format(e))
+                    fixed = 0
+                self.backfill_done = fixed == 0
+                continue
+            self.sleep(remaining)
@@ -0,0 +1,299 @@
+#######################################################################################################################
+#
+#   Monthly shards, retention and compaction for long-running databases.
+#
+#   The main database keeps the hot data: the hourly listings of the last "hot_months" months (the current
+#   month included) plus everything that stays small, i.e. item names, snapshots, the daily and weekly rollups
+#   and the anomaly state.  compact() moves older hourly listings and raw commodity snapshots, one calendar
+#   month at a time, into their own file next to the main database (shards/listings_<year>_<month>.db, same
+#   listings and commodity_snapshots schema) and deletes them from the main file.  Old history stays available
+#   at full resolution in its shard and at daily/weekly resolution in the rollups, which are kept at ingest
+#   time and never move.
+#
+#   The shards table in the main database is the catalog: one row per month with its file, time range, row
+#   count (listings and commodity snapshots together) and state.  Shards older than "archive_after_months" are
+#   gzipped in place (state "archived") and left out of chart queries until restore_shard() unpacks them
+#   again.  Reads that must see everything (rebuilds, the Parquet export, stored commodity snapshots) pass
+#   include_archived=True and read a temporary unpacked copy instead.
+#
+#   Reads that may reach past the hot window go through query_listings() or listing_chunks(), which ATTACH
+#   every shard overlapping the requested range in turn, oldest first, and run the same statement against each
+#   and then against the main file (see price_history.py, parquet_export.py and the rebuilds and
+#   load_commodity_snapshot in database_gateway.py).
+#
+#   A month is kept in one place per realm: DatabaseGateway writes a snapshot older than the hot window into
+#   its month's shard (attach_month), after moving whatever that realm still holds of the month in the main
+#   file, so re-ingesting or replaying old snapshots never splits a month or duplicates rows.  Commodity
+#   snapshots are handled the same way per month.
+#
+#   Moving a month copies and deletes inside one transaction over the attached shard.  In WAL mode SQLite
+#   does not guarantee atomicity across the two files, so a crash can leave rows in both; the copy is an
+#   upsert, and running compact() again finishes the move.  Freed pages in the main file are reused by new
+#   snapshots, and handed back to the filesystem with incremental vacuum when the database was created with
+#   auto_vacuum=INCREMENTAL (the default profile), so compaction never needs a full, locking VACUUM.
+#
+#######################################################################################################################
+
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+import generic_util as gu
+
+# global variables:
+_default_retention_config: dict = \
+    {
+        "hot_months": 2,  # months of hourly listings kept in the main database, the current one included
+        "archive_after_months": 12  # shards whose month ended longer ago than this are gzipped
+    }
+_shard_schema: str = "shard"
+_listing_columns: str = "item_id, realm_id, snapshot_ts, min_price, median_price, mean_price, p10_price, " \
+                        "p90_price, quantity, listings"
+_commodity_columns: str = "region, snapshot_ts, auction_count, item_id_column, unit_price_column, quantity_column"
+
+
+class ShardManager(object):
+
+    def __init__(self, db_gateway, logger=None, retention_config: dict = None, shard_path: str = None):
+        self.dg = db_gateway
+        self.log = logger if logger is not None else db_gateway.log
+        self.config = dict(_default_retention_config)
+        self.config.update(retention_config or {})
+        if shard_path is None:
+            shard_path = os.path.join(os.path.dirname(db_gateway.db_file), "shards")
+        self.shard_path = shard_path
+        self.unpacked = {}  # file name of an archived shard -> temporary unpacked copy, see release_unpacked
+
+    def hot_start(self, now: float = None) -> int:
+        # start of the oldest month kept in the main database
+        now = time.time() if now is None else now
+        return months_before(gu.get_period_start(int(now), "monthly"), self.config["hot_months"] - 1)
+
+    def cold_month(self, snapshot_ts: int):
+        # start of the snapshot's month when that month belongs in a shard, otherwise None
+        if snapshot_ts >= self.hot_start():
+            return None
+        return gu.get_period_start(snapshot_ts, "monthly")
+
+    def compact(self, now: float = None) -> int:
+        # moves hourly listings and commodity snapshots older than the hot window into monthly shards, archives
+        # cold shards, returns the number of rows moved
+        now = time.time() if now is None else now
+        start = time.perf_counter()
+        cutoff = self.hot_start(now)
+        realm_ids = [row[0] for row in self.dg.conn.execute("SELECT DISTINCT realm_id FROM listings")]
+        months = []
+        for realm_id in realm_ids:
+            oldest = self.dg.conn.execute("SELECT MIN(snapshot_ts) FROM listings WHERE realm_id = ?",
+                                          (realm_id,)).fetchone()[0]
+            month_start = gu.get_period_start(oldest, "monthly")
+            while month_start < cutoff:
+                if month_start not in months and self.has_listings(realm_id, month_start):
+                    months.append(month_start)
+                month_start = gu.get_period_end(month_start, "monthly")
+        for row in self.dg.conn.execute("SELECT DISTINCT snapshot_ts FROM commodity_snapshots WHERE snapshot_ts < ?",
+                                        (cutoff,)).fetchall():
+            month_start = gu.get_period_start(row[0], "monthly")
+            if month_start not in months:
+                months.append(month_start)
+        moved = 0
+        for month_start in sorted(months):
+            moved += self.move_month(month_start, realm_ids)
+        archived = self.archive_cold_shards(now)
+        # run as a script, execute() would only step the pragma once and free a single page; the checkpoint
+        # lets the file shrink now rather than at the next automatic one
+        self.dg.conn.executescript("PRAGMA incremental_vacuum; PRAGMA wal_checkpoint(PASSIVE);")
+        self.log.info("Compaction moved {} rows from {} months into shards and archived {} shards in {:.2f}s".format(
+            moved, len(months), archived, time.perf_counter() - start))
+        return moved
+
+    def has_listings(self, realm_id: int, month_start: int) -> bool:
+        statement = "SELECT 1 FROM listings WHERE realm_id = ? AND snapshot_ts >= ? AND snapshot_ts < ? LIMIT 1"
+        month_end = gu.get_period_end(month_start, "monthly")
+        return self.dg.conn.execute(statement, (realm_id, month_start, month_end)).fetchone() is not None
+
+    def has_commodities(self, month_start: int) -> bool:
+        statement = "SELECT 1 FROM commodity_snapshots WHERE snapshot_ts >= ? AND snapshot_ts < ? LIMIT 1"
+        month_end = gu.get_period_end(month_start, "monthly")
+        return self.dg.conn.execute(statement, (month_start, month_end)).fetchone() is not None
+
+    def move_month(self, month_start: int, realm_ids: list) -> int:
+        # moves the listings of realm_ids and every commodity snapshot of the month, returns the rows moved
+        month_end = gu.get_period_end(month_start, "monthly")
+        file_name = self.attach_month(month_start)
+        try:
+            moved = 0
+            with self.dg.conn:
+                for realm_id in realm_ids:
+                    params = (realm_id, month_start, month_end)
+                    self.dg.conn.execute("INSERT OR REPLACE INTO {}.listings ({}) SELECT {} FROM main.listings "
+                                         "WHERE realm_id = ? AND snapshot_ts >= ? AND snapshot_ts < ?".format(
+                                             _shard_schema, _listing_columns, _listing_columns), params)
+                    moved += self.dg.conn.execute("DELETE FROM main.listings WHERE realm_id = ? AND snapshot_ts >= ? "
+                                                  "AND snapshot_ts < ?", params).rowcount
+                self.dg.conn.execute("INSERT OR REPLACE INTO {}.commodity_snapshots ({}) SELECT {} FROM "
+                                     "main.commodity_snapshots WHERE snapshot_ts >= ? AND snapshot_ts < ?".format(
+                                         _shard_schema, _commodity_columns, _commodity_columns),
+                                     (month_start, month_end))
+                moved += self.dg.conn.execute("DELETE FROM main.commodity_snapshots WHERE snapshot_ts >= ? "
+                                              "AND snapshot_ts < ?", (month_start, month_end)).rowcount
+                self.dg.conn.execute(*self.catalog_update(month_start))
+        finally:
+            self.detach()
+        self.log.info("Moved {} rows of {} into {}".format(moved, period_label(month_start), file_name))
+        return moved
+
+    def attach_month(self, month_start: int) -> str:
+        # attaches the month's shard as "shard" for writing, creating or restoring it first, returns its file name
+        period = period_label(month_start)
+        shard = self.catalog_entry(period)
+        if shard is not None and shard["state"] == "archived":
+            self.restore_shard(period)
+        file_name = shard_file_name(period)
+        if not os.path.exists(self.shard_path):
+            os.makedirs(self.shard_path)
+        self.attach(os.path.join(self.shard_path, file_name))
+        self.dg.create_shard_tables(_shard_schema)
+        return file_name
+
+    def catalog_update(self, month_start: int, added_rows: int = None) -> (str, tuple):
+        # statement and parameters recording the attached shard of the month in the catalog: its listings and
+        # commodity snapshots are counted, or with added_rows (an ingest) the stored count is increased without
+        # scanning the shard
+        period = period_label(month_start)
+        params = (period, shard_file_name(period), month_start, gu.get_period_end(month_start, "monthly"))
+        if added_rows is None:
+            statement = "INSERT OR REPLACE INTO main.shards (period, file_name, start_ts, end_ts, row_count, " \
+                        "state, updated_at) VALUES (?, ?, ?, ?, (SELECT COUNT(*) FROM {0}.listings) + " \
+                        "(SELECT COUNT(*) FROM {0}.commodity_snapshots), 'active', ?)".format(_shard_schema)
+            return statement, params + (int(time.time()),)
+        statement = "INSERT INTO main.shards (period, file_name, start_ts, end_ts, row_count, state, updated_at) " \
+                    "VALUES (?, ?, ?, ?, ?, 'active', ?) ON CONFLICT(period) DO UPDATE SET " \
+                    "row_count = row_count + excluded.row_count, updated_at = excluded.updated_at"
+        return statement, params + (added_rows, int(time.time()))
+
+    def listings_table(self) -> str:
+        # the attached shard's listings table, for statements written while attach_month is in effect
+        return _shard_schema + ".listings"
+
+    def commodities_table(self) -> str:
+        # the attached shard's commodity_snapshots table, see listings_table
+        return _shard_schema + ".commodity_snapshots"
+
+    def archive_cold_shards(self, now: float) -> int:
+        cutoff = months_before(gu.get_period_start(int(now), "monthly"), self.config["archive_after_months"])
+        cold = [row[0] for row in self.dg.conn.execute(
+            "SELECT period FROM shards WHERE state = 'active' AND end_ts <= ?", (cutoff,))]
+        for period in cold:
+            shard = self.catalog_entry(period)
+            filename = os.path.join(self.shard_path, shard["file_name"])
+            with open(filename, 'rb') as rf, gzip.open(filename + ".gz", 'wb') as wf:
+                shutil.copyfileobj(rf, wf)
+            self.set_state(period, "archived")
+            os.remove(filename)
+            self.log.info("Archived shard {} to {}.gz".format(period, shard["file_name"]))
+        return len(cold)
+
+    def restore_shard(self, period: str):
+        shard = self.catalog_entry(period)
+        filename = os.path.join(self.shard_path, shard["file_name"])
+        with gzip.open(filename + ".gz", 'rb') as rf, open(filename + ".tmp", 'wb') as wf:
+            shutil.copyfileobj(rf, wf)
+        os.replace(filename + ".tmp", filename)
+        self.set_state(period, "active")
+        os.remove(filename + ".gz")
+        self.log.info("Restored shard {} from {}.gz".format(period, shard["file_name"]))
+
+    def catalog_entry(self, period: str):
+        row = self.dg.conn.execute("SELECT period, file_name, start_ts, end_ts, row_count, state FROM shards "
+                                   "WHERE period = ?", (period,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(["period", "file_name", "start_ts", "end_ts", "row_count", "state"], row))
+
+    def set_state(self, period: str, state: str):
+        with self.dg.conn:
+            self.dg.conn.execute("UPDATE shards SET state = ?, updated_at = ? WHERE period = ?",
+                                 (state, int(time.time()), period))
+
+    def shards_in_range(self, start_ts: int, end_ts: int, states: tuple = ("active",)) -> list:
+        # [(file_name, state), ...] oldest first
+        return self.dg.conn.execute(
+            "SELECT file_name, state FROM shards WHERE state IN (SELECT value FROM json_each(?)) AND end_ts > ? "
+            "AND start_ts < ? ORDER BY start_ts", (json.dumps(list(states)), start_ts, end_ts)).fetchall()
+
+    def query_listings(self, statement: str, params, start_ts: int, end_ts: int,
+                       include_archived: bool = False) -> list:
+        # statement reads "{}.listings" (or "{}.commodity_snapshots"), formatted with every shard overlapping
+        # [start_ts, end_ts), oldest first, and then with "main"; returns the rows of all of them
+        rows = []
+        for chunk in self.listing_chunks(statement, params, start_ts, end_ts, include_archived=include_archived):
+            rows += chunk
+        return rows
+
+    def listing_chunks(self, statement: str, params, start_ts: int, end_ts: int, chunk_rows: int = 10000,
+                       include_archived: bool = False):
+        # same as query_listings, yielding the rows in chunks of up to chunk_rows
+        # archived shards are skipped unless include_archived, which reads them from a temporary unpacked copy
+        # kept until release_unpacked()
+        if not include_archived:
+            archived = [file_name for file_name, state in self.shards_in_range(start_ts, end_ts, ("archived",))]
+            if len(archived) > 0:
+                self.log.warning("Skipping archived shards {}, restore them to read their hourly listings".format(
+                    ", ".join(archived)))
+        states = ("active", "archived") if include_archived else ("active",)
+        for file_name, state in self.shards_in_range(start_ts, end_ts, states) + [(None, None)]:
+            if file_name is not None:
+                self.attach(self.unpack(file_name) if state == "archived" else
+                            os.path.join(self.shard_path, file_name), read_only=state == "archived")
+            cursor = self.dg.conn.execute(statement.format("main" if file_name is None else _shard_schema), params)
+            try:
+                while True:
+                    rows = cursor.fetchmany(chunk_rows)
+                    if len(rows) == 0:
+                        break
+                    yield rows
+            finally:
+                cursor.close()
+                if file_name is not None:
+                    self.detach()
+
+    def unpack(self, file_name: str) -> str:
+        # temporary copy of an archived shard, unpacked once and reused until release_unpacked()
+        if file_name not in self.unpacked:
+            handle, filename = tempfile.mkstemp(suffix=".db")
+            with gzip.open(os.path.join(self.shard_path, file_name + ".gz"), 'rb') as rf, os.fdopen(handle, 'wb') as wf:
+                shutil.copyfileobj(rf, wf)
+            self.unpacked[file_name] = filename
+        return self.unpacked[file_name]
+
+    def release_unpacked(self):
+        for filename in self.unpacked.values():
+            os.remove(filename)
+        self.unpacked = {}
+
+    def attach(self, filename: str, read_only: bool = False):
+        if self.dg.read_only or read_only:
+            self.dg.conn.execute("ATTACH DATABASE ? AS {}".format(_shard_schema), ("file:{}?mode=ro".format(filename),))
+        else:
+            self.dg.conn.execute("ATTACH DATABASE ? AS {}".format(_shard_schema), (filename,))
+
+    def detach(self):
+        self.dg.conn.execute("DETACH DATABASE {}".format(_shard_schema))
+
+
+def months_before(month_start: int, months: int) -> int:
+    start = datetime.datetime.fromtimestamp(month_start)
+    month_index = start.year * 12 + start.month - 1 - months
+    return int(start.replace(year=month_index // 12, month=month_index % 12 + 1).timestamp())
+
+
+def period_label(month_start: int) -> str:
+    return time.strftime("%Y-%m", time.localtime(month_start))
+
+
+def shard_file_name(period: str) -> str:
+    return "listings_{}.db".format(period.replace("-", "_"))
@@ -0,0 +1,55 @@
+#######################################################################################################################
+#
+#   Builds realistic raw auction payloads from the bundled sample snapshot, for benchmarks and offline testing.
+#   The sample in data/auction_sample_data holds one cleaned auction per item; build_auction_payload turns it
+#   back into the API's raw format and scales it to any number of auctions by re-listing items at jittered
+#   prices.  A fixed seed keeps every run identical.
+#
+#######################################################################################################################
+
+import json
+import os
+import random
+
+# global variables:
+_sample_file: str = os.path.join(os.path.dirname(__file__), "data", "auction_sample_data", "example_auction_data.json")
+_time_left: [str] = ["SHORT", "MEDIUM", "LONG", "VERY_LONG"]
+
+
+def load_sample_items() -> dict:
+    with open(_sample_file, 'r') as rf:
+        return json.load(rf)
+
+
+def build_auction_payload(scale: float = 1.0, seed: int = 1) -> dict:
+    rng = random.Random(seed)
+    sample = load_sample_items()
+    items = sorted(sample.items(), key=lambda pair: int(pair[0]))
+    auction_count = int(len(items) * scale)
+    auctions = []
+    for auction_id in range(auction_count):
+        item_id, listing = items[auction_id % len(items)]
+        jitter = 1.0 if auction_id < len(items) else rng.uniform(0.7, 1.5)
+        auction = {
+            "id": auction_id + 1,
+            "item": {"id": int(item_id)},
+            "quantity": listing.get("quantity", 1),
+            "time_left": rng.choice(_time_left)
+        }
+        if listing.get("unit_price", "NONE") != "NONE":
+            auction["unit_price"] = max(1, int(listing["unit_price"] * jitter))
+        elif listing.get("buyout", "NONE") != "NONE":
+            auction["buyout"] = max(1, int(listing["buyout"] * jitter))
+        auctions.append(auction)
+    return {
+        "_links": {"self": {"href": "https://us.api.blizzard.com/data/wow/connected-realm/0/auctions"}},
+        "connected_realm": {"href": "https://us.api.blizzard.com/data/wow/connected-realm/0"},
+        "auctions": auctions
+    }
+
+
+def write_auction_payload(filename: str, scale: float = 1.0, seed: int = 1) -> str:
+    payload = build_auction_payload(scale, seed)
+    with open(filename, 'w') as wf:
+        json.dump(payload, wf)
+    return filename
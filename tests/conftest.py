@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules live flat in the repository root, which is itself a package (__init__.py), so put it on the path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
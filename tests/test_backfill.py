@@ -0,0 +1,109 @@
+import json
+import logging
+import socket
+import generic_util as gu
+from api_gateway import APIGateway
+from backfill import ItemBackfill, TokenBucket
+from database_gateway import DatabaseGateway
+import mock_server
+from mock_server import MockBattleNet
+
+_log = logging.getLogger("test_backfill")
+_named_items: [int] = [19019, 25, 35, 36, 37]
+_missing_items: [int] = [404, 4040]  # answered 404 by the mock
+_unreachable_items: [int] = [500, 5000]  # sent to a port nobody listens on
+_stats: dict = {"min_price": 100, "median_price": 100, "mean_price": 100, "p10_price": 100, "p90_price": 100,
+                "quantity": 1, "listings": 1}
+
+
+class FakeClock(object):
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+class ItemMock(MockBattleNet):
+
+    def item_response(self, item_id: str):
+        if int(item_id) in _missing_items:
+            return "item", 404, {}, b""
+        return super().item_response(item_id)
+
+
+class UnreachableItemGateway(APIGateway):
+
+    def __init__(self, *args, dead_url: str = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dead_url = dead_url
+
+    def build_url(self, url_type, data) -> str:
+        if url_type == "item" and int(data) in _unreachable_items:
+            return self.dead_url + "/us/data/wow/item/{}".format(data)
+        return super().build_url(url_type, data)
+
+
+def closed_port_url() -> str:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return "http://127.0.0.1:{}".format(s.getsockname()[1])
+
+
+def test_backfill_against_the_mock_server(tmp_path, monkeypatch):
+    monkeypatch.setattr(gu, "_cache_folder", str(tmp_path))  # keep the token cache out of data/cache
+    mock = ItemMock(logger=_log)
+    mock.start()
+    dg = DatabaseGateway(_log, db_file=str(tmp_path / "backfill.db"))
+    try:
+        config_file = str(tmp_path / "config.json")
+        with open(config_file, 'w') as wf:
+            json.dump({"token_data": {"client_id": "mock", "client_secret": "mock"}, "base_urls": mock.base_urls(),
+                       "realm_id": [74], "region": "us", "locale": "en_US", "http": {"retries": 0}}, wf)
+        ag = UnreachableItemGateway(config_file, _log, dead_url=closed_port_url())
+        dg.start_connection()
+        items = _named_items + _missing_items + _unreachable_items
+        assert dg.add_auction_data({item_id: _stats for item_id in items}, realm_id=74)
+        batches = []
+        update_items_data = dg.update_items_data
+        monkeypatch.setattr(dg, "update_items_data", lambda rows: batches.append(rows) or update_items_data(rows))
+        assert ItemBackfill(ag, dg, _log, concurrency=4, requests_per_second=1000).run(100) == \
+            len(_named_items) + len(_missing_items)
+        ag.close()
+        assert len(batches) == 1
+        names = {row[0]: (row[1], row[2]) for row in dg.conn.execute("SELECT * FROM item_names")}
+    finally:
+        dg.close_connection()
+        mock.stop()
+    for item_id in _named_items:
+        quality = mock_server._qualities[item_id % len(mock_server._qualities)]
+        assert names[item_id] == ("Mock Item {}".format(item_id), quality)
+    for item_id in _missing_items:
+        assert names[item_id] == ("UNKNOWN", "UNKNOWN")
+    for item_id in _unreachable_items:
+        assert names[item_id] == ("UNDEFINED", "UNDEFINED")  # retried on a later run
+
+
+def test_token_bucket_keeps_to_the_rate():
+    clock = FakeClock()
+    rate = 4.0
+    bucket = TokenBucket(rate, clock=clock.time, sleep=clock.sleep)
+    granted = []
+    for _ in range(20):
+        bucket.acquire()
+        granted.append(clock.now)
+    # starts empty, so even the first request waits for a token, and then one is granted every 1 / rate
+    assert granted == [1000.0 + (i + 1) / rate for i in range(20)]
+    clock.now += 10  # idle: the bucket fills up to its capacity of 1, not 10 * rate
+    burst_start = clock.now
+    for _ in range(10):
+        bucket.acquire()
+        granted.append(clock.now)
+    assert granted[20] == burst_start
+    assert granted[21] == burst_start + 1 / rate
+    # no one-second window sees more than rate + 1 requests
+    assert max(sum(1 for t in granted if start <= t < start + 1) for start in granted) <= rate + 1
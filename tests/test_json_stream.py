@@ -0,0 +1,61 @@
+import json
+import pytest
+from json_stream import iter_array_items
+
+_payload: dict = \
+    {
+        "_links": {"self": {"href": "https://us.api.blizzard.com/data/wow/connected-realm/0/auctions"}},
+        "connected_realm": {"href": "https://us.api.blizzard.com/data/wow/connected-realm/0"},
+        "auctions": [
+            {"id": 1, "item": {"id": 36}, "quantity": 1, "buyout": 226189600, "time_left": "LONG"},
+            {"id": 2, "item": {"id": 38, "name": "Ogre’s Cleaver é€"}, "quantity": 3,
+             "unit_price": 4860000, "time_left": "SHORT"},
+            {"id": 3, "item": {"id": 39, "modifiers": [{"type": 9, "value": 35}]}, "quantity": 20,
+             "unit_price": 7297400, "time_left": "VERY_LONG"}
+        ],
+        "commodities": {"href": "https://us.api.blizzard.com/data/wow/auctions/commodities"}
+    }
+
+
+def chunked(data, size: int) -> list:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7])
+def test_chunk_boundaries(size):
+    body = json.dumps(_payload, ensure_ascii=False, indent=1).encode("utf-8")
+    assert list(iter_array_items(chunked(body, size), "auctions")) == _payload["auctions"]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7])
+def test_str_chunks(size):
+    body = json.dumps(_payload, ensure_ascii=False)
+    assert list(iter_array_items(chunked(body, size), "auctions")) == _payload["auctions"]
+
+
+def test_utf8_character_split_across_chunks():
+    body = '{"auctions": [{"name": "€é"}]}'.encode("utf-8")
+    split = body.index("€".encode("utf-8")) + 1  # inside the three bytes of the euro sign
+    chunks = [body[:split], body[split:split + 1], body[split + 1:split + 3], body[split + 3:]]
+    assert list(iter_array_items(chunks, "auctions")) == [{"name": "€é"}]
+
+
+def test_key_before_the_array():
+    # the key shows up as a value and inside another object before the real array
+    body = json.dumps({"title": "auctions", "meta": {"auctions": 2}, "auctions": [{"id": 1}, {"id": 2}]})
+    for size in [1, 3, len(body)]:
+        assert list(iter_array_items(chunked(body.encode("utf-8"), size), "auctions")) == [{"id": 1}, {"id": 2}]
+
+
+@pytest.mark.parametrize("body", ['{"auctions": []}', '{"auctions" :\n [ \n ] , "other": [{"id": 1}]}'])
+def test_empty_array(body):
+    assert list(iter_array_items(chunked(body.encode("utf-8"), 2), "auctions")) == []
+
+
+def test_missing_key():
+    assert list(iter_array_items([b'{"other": [{"id": 1}]}'], "auctions")) == []
+
+
+def test_truncated_payload_raises():
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_array_items([b'{"auctions": [{"id": 1}, {"id": '], "auctions"))
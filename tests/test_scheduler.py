@@ -0,0 +1,124 @@
+import logging
+from email.utils import formatdate
+from scheduler import Scheduler
+
+_start: float = 1699999200.0  # top of an hour
+_log = logging.getLogger("test_scheduler")
+
+
+class FakeClock(object):
+
+    def __init__(self, now: float):
+        self.now = now
+        self.sleeps = []
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeGateway(object):
+
+    def __init__(self, last_modified: float = None):
+        self.last_modified = formatdate(last_modified, usegmt=True) if last_modified is not None else None
+
+
+class FakeController(object):
+    # collections take collect_seconds and return statuses in turn; each backfill batch takes backfill_seconds
+    # and fixes the next count in backfill_counts (0 once they run out)
+
+    def __init__(self, clock: FakeClock, statuses: list, last_modified: list = None, collect_seconds: float = 30,
+                 backfill_counts: list = None, backfill_seconds: float = 60):
+        self.clock = clock
+        self.statuses = list(statuses)
+        self.last_modified = list(last_modified or [])
+        self.collect_seconds = collect_seconds
+        self.backfill_counts = list(backfill_counts or [])
+        self.backfill_seconds = backfill_seconds
+        self.gateways = [FakeGateway()]
+        self.keep_connection = False
+        self.collections = []  # clock time of each collection
+        self.backfills = []  # clock time each backfill batch started
+        self.runs = 0
+
+    def start_run(self):
+        self.runs += 1
+
+    def finish_run(self):
+        return {}
+
+    def release_connection(self):
+        pass
+
+    def collect_and_store_data(self) -> list:
+        self.collections.append(self.clock.now)
+        self.clock.now += self.collect_seconds
+        if len(self.last_modified) > 0:
+            self.gateways[0] = FakeGateway(self.last_modified.pop(0))
+        return [{"status": self.statuses.pop(0) if len(self.statuses) > 0 else "not_modified"}]
+
+    def fix_unnamed_items(self, fix_num: int = None) -> int:
+        self.backfills.append(self.clock.now)
+        self.clock.now += self.backfill_seconds
+        return self.backfill_counts.pop(0) if len(self.backfill_counts) > 0 else 0
+
+
+def run_scheduler(controller: FakeController, clock: FakeClock, cycles: int, config: dict = None) -> Scheduler:
+    scheduler = Scheduler(controller, _log, config, clock=clock.time, sleep=clock.sleep)
+    assert scheduler.run(max_cycles=cycles) == cycles
+    return scheduler
+
+
+def test_collections_align_to_last_modified():
+    # Blizzard refreshed at _start - 600, so the next snapshot is due at _start + 3000, collected 120s later
+    clock = FakeClock(_start)
+    controller = FakeController(clock, ["ok", "ok", "ok"],
+                                last_modified=[_start - 600, _start + 3000, _start + 6600])
+    run_scheduler(controller, clock, 3)
+    assert controller.collections == [_start, _start + 3120, _start + 6720]
+    assert controller.runs == 3
+    assert controller.keep_connection is False
+
+
+def test_late_snapshot_is_polled_every_retry_interval():
+    # the refresh due at _start + 3000 only shows up two polls late
+    clock = FakeClock(_start)
+    controller = FakeController(clock, ["ok", "not_modified", "not_modified", "ok", "ok"],
+                                last_modified=[_start - 600, _start - 600, _start - 600, _start + 3500,
+                                               _start + 7100], collect_seconds=0)
+    run_scheduler(controller, clock, 5, {"retry_interval": 300})
+    assert controller.collections == [_start, _start + 3120, _start + 3420, _start + 3720, _start + 7220]
+
+
+def test_without_last_modified_collects_past_the_top_of_the_hour():
+    clock = FakeClock(_start + 1000)
+    controller = FakeController(clock, ["ok", "not_modified", "ok"], collect_seconds=0)
+    run_scheduler(controller, clock, 3)
+    assert controller.collections == [_start + 1000, _start + 3720, _start + 4020]
+
+
+def test_backfill_stops_at_the_margin_and_when_done():
+    clock = FakeClock(_start)
+    controller = FakeController(clock, ["ok", "ok"], last_modified=[_start - 600, _start + 3000],
+                                backfill_counts=[500] * 100, backfill_seconds=100)
+    config = {"backfill_margin": 180}
+    run_scheduler(controller, clock, 2, config)
+    next_collection = _start + 3120
+    # batches keep going while items are fixed, and none starts within the margin of the next collection
+    assert controller.backfills == [_start + 30 + 100 * batch for batch in range(30)]
+    assert all(next_collection - started > config["backfill_margin"] for started in controller.backfills)
+    assert controller.collections == [_start, next_collection]
+
+
+def test_unchanged_snapshot_does_not_restart_backfill():
+    clock = FakeClock(_start)
+    controller = FakeController(clock, ["ok", "not_modified", "ok"],
+                                last_modified=[_start - 600, _start - 600, _start + 3300],
+                                collect_seconds=0, backfill_counts=[0, 0, 0])
+    run_scheduler(controller, clock, 3, {"retry_interval": 300})
+    # one batch after the first snapshot finds nothing; the unchanged snapshot does not restart the backfill
+    assert controller.backfills == [_start]
+    assert controller.collections == [_start, _start + 3120, _start + 3420]